@@ -0,0 +1,29 @@
+# Loads the capacity profile used to size the stacks from
+# config/capacity.yaml.
+
+import os
+import yaml
+
+PROFILES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'config', 'capacity.yaml')
+
+def load_profile(sceptre_user_data, path=PROFILES_PATH):
+    with open(path) as profilesFile:
+        capacityConfig = yaml.safe_load(profilesFile)
+
+    # A stack can pick its own profile, otherwise the active one is used.
+    profileName = sceptre_user_data.get('capacityProfile', capacityConfig['active'])
+    if profileName not in capacityConfig['profiles']:
+        raise ValueError("Unknown capacity profile '{}', must be one of {}".format(
+            profileName, ', '.join(sorted(capacityConfig['profiles']))))
+    return capacityConfig['profiles'][profileName]
+
+INSTANCE_TYPES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance_types.yaml')
+
+def instance_spec(instanceType, path=INSTANCE_TYPES_PATH):
+    # vcpu and memory (MiB) of an instance type
+    with open(path) as typesFile:
+        instanceTypes = yaml.safe_load(typesFile)
+    if instanceType not in instanceTypes:
+        raise ValueError("No spec for instance type '{}' in {}".format(instanceType, path))
+    return instanceTypes[instanceType]
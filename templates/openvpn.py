@@ -2,6 +2,10 @@
 
 from troposphere import Base64, Join, Parameter, Ref, Tags, GetAtt, Output, Template
 from troposphere.ec2 import SecurityGroup, Tag, EIP, EIPAssociation, Instance, BlockDeviceMapping, EBSBlockDevice
+import capacity
+import render_cache
+import render_client
+import template_output
 
 class OpenVPN_Instance(object):
     def __init__(self, sceptre_user_data):
@@ -9,6 +13,7 @@ class OpenVPN_Instance(object):
         self.template.add_description("OpenVPN server Stack")
         self.sceptreUserData = sceptre_user_data
         self.environment = self.sceptreUserData['environment']
+        self.capacity = capacity.load_profile(self.sceptreUserData)
 
         self.add_parameters()
 
@@ -57,7 +62,7 @@ class OpenVPN_Instance(object):
 
         self.instanceTypeParam = t.add_parameter(Parameter(
             "instanceType",
-            Default="t2.small",
+            Default=self.capacity['vpnInstanceType'],
             ConstraintDescription="must be a valid EC2 instance type.",
             Type="String",
             Description="Instance type for EC2 instance."
@@ -65,6 +70,7 @@ class OpenVPN_Instance(object):
 
         self.volumeSizeParam = t.add_parameter(Parameter(
             "volumeSize",
+            Default=str(self.capacity['vpnVolumeSize']),
             Type="String"
         ))
 
@@ -171,9 +177,15 @@ class OpenVPN_Instance(object):
             Value=Ref(self.openVPNSecurityGroup)
             ))
 
-def sceptre_handler(sceptre_user_data):
+def render(sceptre_user_data):
     openvpn = OpenVPN_Instance(sceptre_user_data)
-    return openvpn.template.to_json()
+    return template_output.serialize(openvpn.template, sceptre_user_data)
+
+def sceptre_handler(sceptre_user_data):
+    return render_cache.cached_render(
+        __file__, sceptre_user_data,
+        lambda: render_client.render(__file__, sceptre_user_data, render),
+        dependencies=[capacity.PROFILES_PATH])
 
 if __name__ == "__main__":
     # for debugging
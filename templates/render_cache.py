@@ -0,0 +1,220 @@
+# Caches the JSON rendered by the templates' sceptre_handler on disk.
+#
+# Renders are keyed on a hash of the template source, every helper module
+# and data file beside it, the other files it depends on, the troposphere
+# version and the normalized sceptre_user_data, so any change to those
+# renders afresh.
+#
+# SCEPTRE_RENDER_CACHE=off bypasses the cache,
+# SCEPTRE_RENDER_CACHE_DIR moves it and SCEPTRE_RENDER_CACHE_MAX_BYTES /
+# SCEPTRE_RENDER_CACHE_MAX_AGE (seconds) bound it.
+#
+#   python templates/render_cache.py stats
+#   python templates/render_cache.py clear
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import troposphere
+
+DEFAULT_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'aws-ha-wordpress', 'renders')
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+STATS_FILE = 'stats.json'
+ENTRY_SUFFIX = '.json'
+
+# Counters for this process, the totals are kept in the stats file
+stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'evictions': 0}
+
+
+def enabled():
+    return os.environ.get('SCEPTRE_RENDER_CACHE', 'on').lower() not in ['off', '0', 'false', 'no']
+
+
+def cache_dir():
+    return os.environ.get('SCEPTRE_RENDER_CACHE_DIR', DEFAULT_DIR)
+
+
+def file_digest(path):
+    with open(path, 'rb') as sourceFile:
+        return hashlib.sha256(sourceFile.read()).hexdigest()
+
+
+def helper_files(templatePath):
+    # The helpers a template imports (e.g. template_output.py) and their
+    # data files live in the templates directory, so all of it is hashed.
+    directory = os.path.dirname(os.path.abspath(templatePath))
+    return [os.path.join(directory, fileName) for fileName in sorted(os.listdir(directory))
+            if fileName.endswith(('.py', '.yaml'))]
+
+
+def render_key(templatePath, sceptre_user_data, dependencies=()):
+    key = hashlib.sha256()
+    key.update(troposphere.__version__.encode('utf-8'))
+    templatePath = os.path.abspath(templatePath)
+    paths = [templatePath] + [path for path in helper_files(templatePath) if path != templatePath]
+    for path in paths + [os.path.abspath(path) for path in dependencies]:
+        key.update(file_digest(path).encode('utf-8'))
+    # Sorting the keys makes the hash independent of the YAML key order,
+    # anything that isn't JSON (e.g. resolver objects) is hashed by repr.
+    key.update(json.dumps(sceptre_user_data, sort_keys=True, default=repr).encode('utf-8'))
+    return key.hexdigest()
+
+
+def cached_render(templatePath, sceptre_user_data, render, dependencies=()):
+    """Returns the cached body for this template and user data, calling
+    render() and storing its result on a miss."""
+    if not enabled():
+        stats['bypassed'] += 1
+        return render()
+
+    # The key is taken before rendering as templates modify the user data
+    key = render_key(templatePath, sceptre_user_data, dependencies)
+    directory = cache_dir()
+    entryPath = os.path.join(directory, key + ENTRY_SUFFIX)
+
+    try:
+        with open(entryPath) as entryFile:
+            body = entryFile.read()
+        # Reads refresh the entry so eviction drops the least recently used
+        os.utime(entryPath, None)
+        record('hits')
+        return body
+    except (IOError, OSError):
+        pass
+
+    body = render()
+    record('misses')
+    try:
+        store(directory, entryPath, body)
+        evict(directory)
+    except (IOError, OSError) as e:
+        # A read only or full disk shouldn't stop the render
+        sys.stderr.write('render cache: could not store {}: {}\n'.format(entryPath, e))
+    return body
+
+
+def write_atomic(directory, path, content):
+    handle, tmpPath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(handle, 'w') as tmpFile:
+        tmpFile.write(content)
+    os.replace(tmpPath, path)
+
+
+def store(directory, entryPath, body):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Renders from parallel sceptre runs can race, the rename keeps every
+    # entry whole.
+    write_atomic(directory, entryPath, body)
+
+
+def entries(directory):
+    found = []
+    for name in os.listdir(directory):
+        if not name.endswith(ENTRY_SUFFIX) or name == STATS_FILE:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        found.append((info.st_mtime, info.st_size, path))
+    return sorted(found)
+
+
+def evict(directory, maxBytes=None, maxAge=None, now=None):
+    if maxBytes is None:
+        maxBytes = int(os.environ.get('SCEPTRE_RENDER_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+    if maxAge is None:
+        maxAge = int(os.environ.get('SCEPTRE_RENDER_CACHE_MAX_AGE', DEFAULT_MAX_AGE))
+    now = now or time.time()
+
+    kept = []
+    evicted = 0
+    for modified, size, path in entries(directory):
+        if now - modified > maxAge:
+            evicted += remove(path)
+        else:
+            kept.append((modified, size, path))
+
+    # Oldest first until the cache fits
+    totalBytes = sum(size for modified, size, path in kept)
+    for modified, size, path in kept:
+        if totalBytes <= maxBytes:
+            break
+        evicted += remove(path)
+        totalBytes -= size
+
+    if evicted:
+        record('evictions', evicted)
+    return evicted
+
+
+def remove(path):
+    try:
+        os.remove(path)
+        return 1
+    except OSError:
+        return 0
+
+
+def load_stats(directory):
+    try:
+        with open(os.path.join(directory, STATS_FILE)) as statsFile:
+            return json.load(statsFile)
+    except (IOError, OSError, ValueError):
+        return {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def record(counter, count=1):
+    stats[counter] += count
+    directory = cache_dir()
+    # The totals are best effort, concurrent runs can lose an increment
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        totals = load_stats(directory)
+        totals[counter] = totals.get(counter, 0) + count
+        write_atomic(directory, os.path.join(directory, STATS_FILE), json.dumps(totals, sort_keys=True))
+    except (IOError, OSError):
+        pass
+
+
+def report(directory):
+    totals = load_stats(directory)
+    lookups = totals.get('hits', 0) + totals.get('misses', 0)
+    cached = entries(directory) if os.path.isdir(directory) else []
+    lines = [
+        'cache dir: {}'.format(directory),
+        'entries:   {} ({:.1f} KiB)'.format(len(cached), sum(e[1] for e in cached) / 1024.0),
+        'hits:      {}'.format(totals.get('hits', 0)),
+        'misses:    {}'.format(totals.get('misses', 0)),
+        'hit rate:  {:.1%}'.format(totals.get('hits', 0) / float(lookups) if lookups else 0),
+        'evictions: {}'.format(totals.get('evictions', 0)),
+    ]
+    return '\n'.join(lines)
+
+
+def clear(directory):
+    removed = 0
+    if os.path.isdir(directory):
+        for modified, size, path in entries(directory):
+            removed += remove(path)
+        remove(os.path.join(directory, STATS_FILE))
+    return removed
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    if command == 'stats':
+        print(report(cache_dir()))
+    elif command == 'clear':
+        print('removed {} entries'.format(clear(cache_dir())))
+    else:
+        sys.exit('usage: render_cache.py [stats|clear]')
@@ -0,0 +1,74 @@
+# Hands renders to the warm render daemon (tools/render_daemon.py) when
+# SCEPTRE_RENDER_DAEMON points at its socket. Anything that stops the
+# daemon answering falls back to rendering in this process.
+#
+# The templates delegate their render step from sceptre_handler, which
+# still imports troposphere. The stubs in templates/warm only import this
+# module, so stacks pointed at them skip the imports as well.
+
+import importlib
+import json
+import os
+import socket
+import sys
+
+TIMEOUT = 60
+# Sockets that couldn't be reached aren't tried again by this process
+unreachable = set()
+
+
+def request(socketPath, message):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(TIMEOUT)
+    try:
+        client.connect(socketPath)
+        client.sendall(json.dumps(message).encode('utf-8'))
+        # Closing our side tells the daemon the request is complete
+        client.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def render(templatePath, sceptre_user_data, localRender):
+    socketPath = os.environ.get('SCEPTRE_RENDER_DAEMON')
+    if not socketPath or socketPath in unreachable:
+        return localRender(sceptre_user_data)
+
+    try:
+        response = request(socketPath, {
+            'command': 'render',
+            'templatePath': os.path.abspath(templatePath),
+            'userData': sceptre_user_data,
+        })
+    except (IOError, OSError, TypeError, ValueError) as e:
+        unreachable.add(socketPath)
+        sys.stderr.write('render daemon at {} not used: {}\n'.format(socketPath, e))
+        return localRender(sceptre_user_data)
+
+    if 'error' in response:
+        # Rendering here again gives the error with its own traceback
+        sys.stderr.write('render daemon failed: {}\n'.format(response['error']))
+        return localRender(sceptre_user_data)
+    return response['body']
+
+
+def remote_handler(templateName):
+    """Returns a sceptre_handler for templates/<templateName>.py which
+    doesn't import the template unless the daemon can't be used."""
+    templatePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), templateName + '.py')
+
+    def local_render(sceptre_user_data):
+        # The template's own render, its sceptre_handler would ask the
+        # daemon again
+        return importlib.import_module(templateName).render(sceptre_user_data)
+
+    def sceptre_handler(sceptre_user_data):
+        return render(templatePath, sceptre_user_data, local_render)
+    return sceptre_handler
@@ -3,15 +3,176 @@
 # servers. It also creates an RDS instance for the wordpress database.
 # Template is modified for Sceptre (http://sceptre.ce-tools.cloudreach.com).
 
-from troposphere import Output, Parameter, Ref, Template, Join, Base64
-from troposphere import GetAZs, Select, Join, GetAtt
+import datetime
+import json
+import re
+
+from troposphere import Output, Parameter, Ref, Template, Join, Base64, Tags
+from troposphere import GetAZs, Select, GetAtt
 from troposphere.ec2 import Tag, SecurityGroup, SecurityGroupRule
+import troposphere.ec2 as ec2
 from troposphere.elasticloadbalancing import LoadBalancer, Listener, HealthCheck
-from troposphere.rds import DBSubnetGroup, DBInstance
+from troposphere.elasticloadbalancing import ConnectionDrainingPolicy, ConnectionSettings
+import troposphere.elasticloadbalancingv2 as elbv2
+from troposphere.rds import DBSubnetGroup, DBInstance, DBCluster, DBClusterParameterGroup
+import troposphere.applicationautoscaling as appscaling
+from troposphere.cloudfront import Distribution, DistributionConfig, Origin, CustomOriginConfig
+from troposphere.cloudfront import DefaultCacheBehavior, CacheBehavior, ForwardedValues, Cookies
+from troposphere.cloudfront import S3OriginConfig
+from troposphere.cloudfront import CloudFrontOriginAccessIdentity, CloudFrontOriginAccessIdentityConfig
+from troposphere.s3 import Bucket, BucketPolicy, PublicAccessBlockConfiguration
+from troposphere.s3 import OwnershipControls, OwnershipControlsRule
+from troposphere.iam import Role, InstanceProfile, Policy as IAMPolicy
+from troposphere.efs import FileSystem, MountTarget
+from troposphere.elasticache import CacheCluster, SubnetGroup as CacheSubnetGroup
 from troposphere.autoscaling import AutoScalingGroup, LaunchConfiguration
-from troposphere.policies import UpdatePolicy, AutoScalingRollingUpdate
+from troposphere.autoscaling import ScalingPolicy, StepAdjustments, MetricDimension
+from troposphere.autoscaling import ScheduledAction, MetricsCollection
+from troposphere.autoscaling import MixedInstancesPolicy, InstancesDistribution, LaunchTemplateSpecification
+from troposphere.autoscaling import LaunchTemplate as ASGLaunchTemplate, LaunchTemplateOverrides
+from troposphere.autoscaling import TargetTrackingConfiguration
+from troposphere.autoscaling import PredefinedMetricSpecification, CustomizedMetricSpecification
+from troposphere.cloudwatch import Alarm, MetricDimension as AlarmDimension, Dashboard
+from troposphere.policies import UpdatePolicy, AutoScalingRollingUpdate, AutoScalingScheduledAction
+from troposphere.policies import CreationPolicy, ResourceSignal, AutoScalingCreationPolicy
 from troposphere.autoscaling import Tag as ASTag
 from troposphere import cloudformation as cfn
+import capacity
+import render_cache
+import render_client
+import template_output
+
+# Metrics which scaling policies can be driven from, for each type of load
+# balancer. Each maps to its CloudWatch namespace, metric name, statistic
+# and the resource it is dimensioned on.
+SCALING_METRICS = {
+    'classic': {
+        'cpu': ('AWS/EC2', 'CPUUtilization', 'Average', 'asg'),
+        'requestCount': ('AWS/ELB', 'RequestCount', 'Sum', 'elb'),
+        'latency': ('AWS/ELB', 'Latency', 'Average', 'elb')
+    },
+    'application': {
+        'cpu': ('AWS/EC2', 'CPUUtilization', 'Average', 'asg'),
+        'requestCount': ('AWS/ApplicationELB', 'RequestCountPerTarget', 'Sum', 'targetGroup'),
+        'latency': ('AWS/ApplicationELB', 'TargetResponseTime', 'Average', 'elb')
+    }
+}
+
+# Where the wordpress cookbook installs WordPress.
+WORDPRESS_DIR = '/var/www/wordpress'
+
+# Load balancer health check defaults. The default path is a page dropped
+# by cfn-init which only succeeds when PHP can query the database.
+HEALTH_CHECK_DEFAULTS = {
+    'path': '/healthz.php',
+    'interval': 10,
+    'timeout': 5,
+    'healthyThreshold': 2,
+    'unhealthyThreshold': 3
+}
+
+# PHP and web server tuning defaults. opcacheMemory, reservedMemory,
+# maxChildren and keepAliveTimeout are derived from the instance type and
+# load balancer unless they are set.
+PHP_TUNING_DEFAULTS = {
+    'handler': 'modPhp',
+    'processManager': 'static',
+    'phpProcessMemory': 64,
+    'childrenPerVcpu': 8,
+    'maxRequests': 500,
+    'opcacheMaxFiles': 20000,
+    'opcacheRevalidateFreq': 60,
+    'maxKeepAliveRequests': 1000
+}
+PHP_FPM_SOCKET = '/var/run/php-fpm/www.sock'
+
+# MySQL version used when the capacity profile doesn't set dbEngineVersion,
+# the version existing stacks were created with.
+DB_ENGINE_VERSION = '5.5.46'
+
+# Aurora MySQL defaults, the cluster parameters can be added to or
+# overridden with database clusterParameters.
+AURORA_ENGINE_VERSION = '8.0.mysql_aurora.3.05.2'
+AURORA_CLUSTER_PARAMETERS = {
+    'character_set_server': 'utf8mb4',
+    'collation_server': 'utf8mb4_unicode_ci'
+}
+# Aurora allows up to 15 readers per cluster.
+AURORA_MAX_READERS = 15
+
+# Metrics the Aurora reader count can be scaled on, with their
+# Application Auto Scaling metric type and default target.
+AURORA_READER_METRICS = {
+    'cpu': ('RDSReaderAverageCPUUtilization', 60),
+    'connections': ('RDSReaderAverageDatabaseConnections', 300)
+}
+
+# Varnish page cache defaults, the memory is in MiB and TTLs in seconds.
+# The load balancer sends traffic to port and the web servers send purges
+# to each other on purgePort.
+PAGE_CACHE_DEFAULTS = {
+    'port': 6081,
+    'purgePort': 6091,
+    'memory': 256,
+    'ttl': 300,
+    'staticTtl': 86400,
+    'grace': 3600
+}
+PAGE_CACHE_VCL = '/etc/varnish/default.vcl'
+
+# Requests which always go to PHP, as regular expressions on the URL.
+PAGE_CACHE_BYPASS_URLS = [
+    '^/wp-admin',
+    '^/wp-login\\.php',
+    '^/wp-cron\\.php',
+    '^/xmlrpc\\.php',
+    '^/wp-json/',
+    '[?&]preview=true'
+]
+
+# The CloudWatch agent package and the config cfn-init writes for it.
+CLOUDWATCH_AGENT_RPM = 'https://s3.amazonaws.com/amazoncloudwatch-agent/amazon_linux/amd64/latest/amazon-cloudwatch-agent.rpm'
+CLOUDWATCH_AGENT_CONFIG = '/opt/aws/amazon-cloudwatch-agent/etc/amazon-cloudwatch-agent.json'
+
+# NFS mount options recommended for EFS.
+EFS_MOUNT_OPTIONS = 'nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2,noresvport'
+
+# Cookies WordPress uses to tell logged in users, commenters and password
+# protected posts apart. Dynamic pages are cached per value of these.
+WORDPRESS_COOKIES = [
+    'wordpress_*',
+    'wordpress_logged_in_*',
+    'wp-settings-*',
+    'wp-postpass_*',
+    'comment_author_*'
+]
+
+# ElastiCache engines usable as the WordPress object cache, with the port
+# they listen on, the attribute prefix of their endpoint and the plugin
+# (and path within it) providing the object-cache.php drop-in.
+CACHE_ENGINES = {
+    'memcached': ('11211', 'ConfigurationEndpoint', 'memcached', 'object-cache.php'),
+    'redis': ('6379', 'RedisEndpoint', 'redis-cache', 'includes/object-cache.php')
+}
+
+# Versions of the wordpress.org plugins chef mode installs, so every
+# instance in the fleet runs the same code. pluginVersions in
+# sceptre_user_data overrides them.
+PLUGIN_VERSIONS = {
+    'amazon-s3-and-cloudfront': '3.2.9',
+    'hyperdb': '1.8',
+    'memcached': '4.0.0',
+    'redis-cache': '2.5.4'
+}
+
+# Constants chef writes into wp-config.php which belong to one stack. A
+# baked AMI still has the bake time stack's values, so they are removed
+# before wp-config-aws.php is loaded with this stack's ones.
+STACK_CONSTANTS = [
+    'DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_HOST',
+    'WP_CACHE', 'WP_CACHE_KEY_SALT', 'WP_REDIS_HOST', 'WP_REDIS_PORT',
+    'AS3CF_SETTINGS'
+]
 
 class Wordpress(object):
     def __init__(self, sceptre_user_data):
@@ -19,6 +180,16 @@ class Wordpress(object):
         self.template.add_description("VPC Stack")
         self.sceptreUserData = sceptre_user_data
         self.environment = self.sceptreUserData['environment']
+        self.loadBalancerConfig = self.sceptreUserData.get('loadBalancer', {})
+        self.loadBalancerType = self.loadBalancerConfig.get('type', 'classic')
+        if self.loadBalancerType not in SCALING_METRICS:
+            raise ValueError("Unknown load balancer type '{}', must be one of {}".format(
+                self.loadBalancerType, ', '.join(sorted(SCALING_METRICS))))
+        self.capacity = capacity.load_profile(self.sceptreUserData)
+        # With the page cache the load balancer talks to Varnish rather than
+        # httpd on the web servers.
+        self.pageCache = self.page_cache_settings()
+        self.webPort = str(self.pageCache['port']) if self.pageCache else '80'
 
         self.add_parameters()
 
@@ -33,7 +204,16 @@ class Wordpress(object):
         self.add_elb()
         self.add_security_groups()
         self.add_rds()
+        self.add_cache()
+        self.add_shared_content()
+        self.add_media_bucket()
+        self.add_monitoring()
+        self.add_instance_role()
+        self.add_cdn()
         self.add_autoscaling_group()
+        self.add_scaling_policies()
+        self.add_scheduled_actions()
+        self.add_dashboard()
 
         self.add_outputs()
 
@@ -107,33 +287,67 @@ class Wordpress(object):
             NoEcho=True,
             Type="Number",
             Description="The size of the WordPress database in Gb.",
-            Default='5',
+            Default=str(self.capacity['dbAllocatedStorage']),
             MinValue='5',
             MaxValue='1024'
         ))
 
+        self.amiIdParam = t.add_parameter(Parameter(
+            "amiId",
+            Type="AWS::EC2::Image::Id",
+            Default="ami-0b33d91d", #TODO Mapping for different regions
+            Description="AMI for the web servers, a baked WordPress AMI when bootMode is baked."
+        ))
+
         self.vpnSgIdParam = t.add_parameter(Parameter(
             "vpnSgId",
             Type="String",
             Description="The ID of the VPN security group."
         ))
 
+        if self.loadBalancerType == 'application':
+            self.certificateArnParam = t.add_parameter(Parameter(
+                "certificateArn",
+                Type="String",
+                Description="ARN of the ACM certificate used by the HTTPS listener."
+            ))
+
+    def subnet_ids(self, tier):
+        # The subnet IDs of a tier in AZ order, for as many AZs as the VPC
+        # stack has outputs for in sceptre_user_data.
+        subnets = self.sceptreUserData['subnets']
+        subnetIds = []
+        while '{}AZ{}Id'.format(tier, len(subnetIds)+1) in subnets:
+            subnetIds.append(subnets['{}AZ{}Id'.format(tier, len(subnetIds)+1)])
+        if not subnetIds:
+            raise ValueError("No {}AZ1Id subnet in sceptre_user_data".format(tier))
+        return subnetIds
+
     def add_elb(self):
         t = self.template
 
+        elbIngress = [
+            SecurityGroupRule(
+                ToPort='80',
+                FromPort='80',
+                IpProtocol='tcp',
+                CidrIp="0.0.0.0/0"
+            )
+        ]
+        if self.loadBalancerType == 'application':
+            # HTTPS is terminated on the ALB
+            elbIngress.append(SecurityGroupRule(
+                ToPort='443',
+                FromPort='443',
+                IpProtocol='tcp',
+                CidrIp="0.0.0.0/0"
+            ))
+
         self.elbSg = t.add_resource(SecurityGroup(
             'ElbSecurityGroup',
             VpcId=Ref(self.vpcIdParam),
             GroupDescription='Security group for ELB.',
-            SecurityGroupIngress=[
-                SecurityGroupRule(
-                    ToPort='80',
-                    FromPort='80',
-                    IpProtocol='tcp',
-                    CidrIp="0.0.0.0/0"
-                )
-                #TODO HTTPS
-            ],
+            SecurityGroupIngress=elbIngress,
             Tags=self.defaultTags + [
                 Tag('Name', Join("", [
                     self.namePrefix,
@@ -142,32 +356,43 @@ class Wordpress(object):
             ]
         ))
 
+        publicSubnetIds = self.subnet_ids('publicInfra')
+
+        if self.loadBalancerType == 'application':
+            self.add_alb(publicSubnetIds)
+            return 0
+
         self.elbListener = Listener(
             'ElbListener',
             LoadBalancerPort="80",
-            InstancePort="80",
+            InstancePort=self.webPort,
             Protocol="HTTP",
             InstanceProtocol="HTTP"
         )
 
+        healthCheck = self.health_check_settings()
         self.elbHealthCheck = HealthCheck(
-            Target="TCP:80",
-            Timeout="2",
-            Interval="5",
-            HealthyThreshold="2",
-            UnhealthyThreshold="2"
+            Target="HTTP:"+self.webPort+healthCheck['path'],
+            Timeout=str(healthCheck['timeout']),
+            Interval=str(healthCheck['interval']),
+            HealthyThreshold=str(healthCheck['healthyThreshold']),
+            UnhealthyThreshold=str(healthCheck['unhealthyThreshold'])
         )
 
-        publicSubnetIds = [ self.sceptreUserData['subnets']['publicInfraAZ1Id'],
-                            self.sceptreUserData['subnets']['publicInfraAZ2Id'],
-                            self.sceptreUserData['subnets']['publicInfraAZ3Id']
-        ]
-
         self.elb = t.add_resource(LoadBalancer(
             'Elb',
             Listeners=[self.elbListener],
             Scheme='internet-facing',
             HealthCheck=self.elbHealthCheck,
+            # In flight requests get this long to finish when an instance
+            # is deregistered, e.g. on scale in or a rolling update.
+            ConnectionDrainingPolicy=ConnectionDrainingPolicy(
+                Enabled=True,
+                Timeout=self.loadBalancerConfig.get('deregistrationDelay', 30)
+            ),
+            ConnectionSettings=ConnectionSettings(
+                IdleTimeout=self.loadBalancerConfig.get('idleTimeout', 60)
+            ),
             CrossZone=True,
             Subnets=publicSubnetIds,
             SecurityGroups=[Ref(self.elbSg)],
@@ -180,6 +405,402 @@ class Wordpress(object):
         ))
         return 0
 
+    def health_check_settings(self):
+        healthCheck = dict(HEALTH_CHECK_DEFAULTS)
+        healthCheck.update(self.loadBalancerConfig.get('healthCheck', {}))
+        if healthCheck['timeout'] >= healthCheck['interval']:
+            raise ValueError("Health check timeout {} must be less than its interval {}".format(
+                healthCheck['timeout'], healthCheck['interval']))
+        return healthCheck
+
+    def health_check_init_config(self):
+        # Drops the page the load balancer checks. It answers 503 unless
+        # PHP runs and can query the database, so broken instances are
+        # taken out of service.
+        path = self.health_check_settings()['path']
+        return cfn.InitConfig(
+            files={
+                WORDPRESS_DIR+path : {
+                    "content" : { "Fn::Join": [ "", [
+                        "<?php\n",
+                        "header('Cache-Control: no-store');\n",
+                        "mysqli_report(MYSQLI_REPORT_OFF);\n",
+                        "$db = mysqli_init();\n",
+                        "$db->options(MYSQLI_OPT_CONNECT_TIMEOUT, 2);\n",
+                        "if (@$db->real_connect('", self.dbHost, "', '", Ref(self.dbUserParam), "', '",
+                        Ref(self.dbPasswordParam), "', '", Ref(self.dbNameParam), "') && $db->query('SELECT 1')) {\n",
+                        "    echo \"OK\\n\";\n",
+                        "} else {\n",
+                        "    http_response_code(503);\n",
+                        "    echo \"Database unavailable\\n\";\n",
+                        "}\n"
+                    ]]},
+                    "mode"  : "000440",
+                    "owner" : "root",
+                    "group" : "apache"
+                }
+            }
+        )
+
+    def php_tuning_settings(self, config):
+        settings = dict(PHP_TUNING_DEFAULTS)
+        settings.update(config)
+        if settings['handler'] not in ['modPhp', 'fpm']:
+            raise ValueError("Unknown PHP handler '{}', must be modPhp or fpm".format(settings['handler']))
+        if settings['processManager'] not in ['static', 'dynamic', 'ondemand']:
+            raise ValueError("Unknown processManager '{}', must be static, dynamic or ondemand".format(
+                settings['processManager']))
+
+        # Mixed instance types share one launch template, so PHP is sized
+        # for the smallest of them.
+        instanceTypes = [self.capacity['webInstanceType']]
+        instanceTypes += (self.sceptreUserData.get('launchTemplate') or {}).get('instanceTypes', [])
+        specs = [capacity.instance_spec(instanceType) for instanceType in instanceTypes]
+        vcpu = min(spec['vcpu'] for spec in specs)
+        memory = min(spec['memory'] for spec in specs)
+
+        settings.setdefault('opcacheMemory', max(64, min(256, memory // 32)))
+        settings.setdefault('reservedMemory', max(256, min(1024, memory // 4)))
+        if 'maxChildren' not in settings:
+            # As many workers as fit in memory, but not so many per vCPU
+            # that they queue for the CPU.
+            phpMemory = memory - settings['reservedMemory'] - settings['opcacheMemory']
+            if self.pageCache:
+                phpMemory -= self.pageCache['memory']
+            settings['maxChildren'] = max(2, min(vcpu * settings['childrenPerVcpu'],
+                                                 phpMemory // settings['phpProcessMemory']))
+        # Connections must outlive the load balancer's idle timeout or it
+        # can send a request down one the instance is closing.
+        settings.setdefault('keepAliveTimeout', self.loadBalancerConfig.get('idleTimeout', 60) + 1)
+        return settings
+
+    def php_tuning_init_config(self, config):
+        # Enables OPcache and sizes the PHP workers and the web server
+        # to the instance. With the fpm handler PHP runs in a php-fpm pool
+        # and httpd passes .php requests to it.
+        settings = self.php_tuning_settings(config)
+        fpm = settings['handler'] == 'fpm'
+        maxChildren = settings['maxChildren']
+
+        opcacheIni = '/etc/php.d/zz-opcache-tuning.ini'
+        httpdConf = '/etc/httpd/conf.d/zz-tuning.conf'
+        files = {
+            opcacheIni : {
+                "content" : "".join([
+                    "opcache.enable=1\n",
+                    "opcache.memory_consumption={}\n".format(settings['opcacheMemory']),
+                    "opcache.interned_strings_buffer=16\n",
+                    "opcache.max_accelerated_files={}\n".format(settings['opcacheMaxFiles']),
+                    # Timestamps are still checked so plugin updates on
+                    # the shared wp-content are picked up.
+                    "opcache.validate_timestamps=1\n",
+                    "opcache.revalidate_freq={}\n".format(settings['opcacheRevalidateFreq'])
+                ]),
+                "mode"  : "000444",
+                "owner" : "root",
+                "group" : "root"
+            }
+        }
+
+        # httpd workers only proxy to php-fpm, so there can be more of
+        # them than PHP workers to hold the idle keep alive connections.
+        httpdWorkers = maxChildren * 2 if fpm else maxChildren
+        httpdConfig = [
+            "KeepAlive On\n",
+            "MaxKeepAliveRequests {}\n".format(settings['maxKeepAliveRequests']),
+            "KeepAliveTimeout {}\n".format(settings['keepAliveTimeout']),
+            "<IfModule prefork.c>\n",
+            "    StartServers {}\n".format(httpdWorkers),
+            "    MinSpareServers {}\n".format(max(1, httpdWorkers // 4)),
+            "    MaxSpareServers {}\n".format(httpdWorkers),
+            "    ServerLimit {}\n".format(httpdWorkers),
+            "    MaxClients {}\n".format(httpdWorkers),
+            "    MaxRequestsPerChild {}\n".format(0 if fpm else settings['maxRequests']),
+            "</IfModule>\n"
+        ]
+        packages = ['php-opcache']
+        services = {
+            "httpd" : { "enabled" : "true", "ensureRunning" : "true",
+            "files" : [opcacheIni, httpdConf] }
+        }
+
+        if fpm:
+            poolConf = '/etc/php-fpm.d/www.conf'
+            pool = [
+                "[www]\n",
+                "user = apache\n",
+                "group = apache\n",
+                "listen = {}\n".format(PHP_FPM_SOCKET),
+                "listen.owner = apache\n",
+                "listen.group = apache\n",
+                "pm = {}\n".format(settings['processManager']),
+                "pm.max_children = {}\n".format(maxChildren),
+                "pm.max_requests = {}\n".format(settings['maxRequests'])
+            ]
+            if settings['processManager'] == 'dynamic':
+                pool += [
+                    "pm.start_servers = {}\n".format(max(1, maxChildren // 2)),
+                    "pm.min_spare_servers = {}\n".format(max(1, maxChildren // 4)),
+                    "pm.max_spare_servers = {}\n".format(max(1, maxChildren // 2))
+                ]
+            elif settings['processManager'] == 'ondemand':
+                pool.append("pm.process_idle_timeout = 10s\n")
+            files[poolConf] = {
+                "content" : "".join(pool),
+                "mode"  : "000444",
+                "owner" : "root",
+                "group" : "root"
+            }
+            httpdConfig += [
+                "<FilesMatch \\.php$>\n",
+                "    SetHandler \"proxy:unix:{}|fcgi://localhost\"\n".format(PHP_FPM_SOCKET),
+                "</FilesMatch>\n"
+            ]
+            packages.append('php-fpm')
+            services["php-fpm"] = { "enabled" : "true", "ensureRunning" : "true",
+            "files" : [opcacheIni, poolConf] }
+
+        files[httpdConf] = {
+            "content" : "".join(httpdConfig),
+            "mode"  : "000444",
+            "owner" : "root",
+            "group" : "root"
+        }
+        return cfn.InitConfig(
+            packages={
+                "yum" : dict((package, []) for package in settings.get('packages', packages))
+            },
+            files=files,
+            services={
+                "sysvinit" : services
+            }
+        )
+
+    def page_cache_settings(self):
+        config = self.sceptreUserData.get('pageCache')
+        if config is None:
+            return None
+        settings = dict(PAGE_CACHE_DEFAULTS)
+        settings.update(config or {})
+        ports = [settings['port'], settings['purgePort']]
+        if 80 in ports or settings['port'] == settings['purgePort']:
+            raise ValueError("Page cache port {} and purgePort {} must differ from each other and from httpd's 80".format(
+                *ports))
+        return settings
+
+    def page_cache_init_config(self):
+        # Varnish in front of httpd on each web server. Logged in users,
+        # commenters, admin pages and anything but GET and HEAD go to PHP,
+        # other cookies are dropped so anonymous pages are shared.
+        settings = self.pageCache
+        bypassCookies = '|'.join(cookie.rstrip('*') for cookie in WORDPRESS_COOKIES)
+        bypassUrls = ' || '.join('req.url ~ "{}"'.format(url) for url in
+                                 PAGE_CACHE_BYPASS_URLS + ['^' + self.health_check_settings()['path'].replace('.', '\\.')])
+        vcl = [
+            "vcl 4.0;\n",
+            "import std;\n",
+            "\n",
+            "backend default {\n",
+            "    .host = \"127.0.0.1\";\n",
+            "    .port = \"80\";\n",
+            "}\n",
+            "\n",
+            "sub vcl_recv {\n",
+            # The purge port is only open to the web servers
+            "    if (std.port(local.ip) == {}) {{\n".format(settings['purgePort']),
+            "        if (req.method == \"PURGE\") {\n",
+            "            return (purge);\n",
+            "        }\n",
+            "        if (req.method == \"BAN\") {\n",
+            "            ban(\"req.http.host == \" + req.http.host + \" && req.url ~ \" + req.url);\n",
+            "            return (synth(200, \"Banned\"));\n",
+            "        }\n",
+            "        return (synth(405, \"Not allowed\"));\n",
+            "    }\n",
+            "    if (req.method == \"PURGE\" || req.method == \"BAN\") {\n",
+            "        return (synth(405, \"Not allowed\"));\n",
+            "    }\n",
+            "    if (req.method != \"GET\" && req.method != \"HEAD\") {\n",
+            "        return (pass);\n",
+            "    }\n",
+            "    if (req.http.Authorization || {}) {{\n".format(bypassUrls),
+            "        return (pass);\n",
+            "    }\n",
+            "    if (req.http.Cookie ~ \"({})\") {{\n".format(bypassCookies),
+            "        return (pass);\n",
+            "    }\n",
+            "    unset req.http.Cookie;\n",
+            "    return (hash);\n",
+            "}\n",
+            "\n",
+            "sub vcl_backend_response {\n",
+            "    if (beresp.http.Set-Cookie || beresp.http.Cache-Control ~ \"(private|no-cache|no-store)\") {\n",
+            "        set beresp.uncacheable = true;\n",
+            "        set beresp.ttl = 120s;\n",
+            "        return (deliver);\n",
+            "    }\n",
+            "    if (bereq.url ~ \"\\.(css|js|png|jpe?g|gif|svg|ico|woff2?)(\\?.*)?$\") {\n",
+            "        set beresp.ttl = {}s;\n".format(settings['staticTtl']),
+            "    } else {\n",
+            "        set beresp.ttl = {}s;\n".format(settings['ttl']),
+            "    }\n",
+            # Stale pages are served while they are refetched or PHP is down
+            "    set beresp.grace = {}s;\n".format(settings['grace']),
+            "}\n",
+            "\n",
+            "sub vcl_deliver {\n",
+            "    if (obj.hits > 0) {\n",
+            "        set resp.http.X-Cache = \"HIT\";\n",
+            "    } else {\n",
+            "        set resp.http.X-Cache = \"MISS\";\n",
+            "    }\n",
+            "}\n"
+        ]
+        # Idle connections must outlive the load balancer's idle timeout
+        # or it can send a request down one Varnish is closing.
+        daemonOptions = "-a :{} -a :{} -f {} -T 127.0.0.1:6082 -S /etc/varnish/secret -s malloc,{}m -p timeout_idle={}".format(
+            settings['port'], settings['purgePort'], PAGE_CACHE_VCL, settings['memory'],
+            self.loadBalancerConfig.get('idleTimeout', 60) + 1)
+        return cfn.InitConfig(
+            packages={
+                "yum" : {
+                    "varnish" : []
+                }
+            },
+            files={
+                PAGE_CACHE_VCL : {
+                    "content" : "".join(vcl),
+                    "mode"  : "000444",
+                    "owner" : "root",
+                    "group" : "root"
+                },
+                "/etc/sysconfig/varnish" : {
+                    "content" : "".join([
+                        "NFILES=131072\n",
+                        "MEMLOCK=82000\n",
+                        "RELOAD_VCL=1\n",
+                        "DAEMON_OPTS=\"{}\"\n".format(daemonOptions)
+                    ]),
+                    "mode"  : "000444",
+                    "owner" : "root",
+                    "group" : "root"
+                }
+            },
+            services={
+                "sysvinit" : {
+                    "varnish" : { "enabled" : "true", "ensureRunning" : "true",
+                    "files" : [PAGE_CACHE_VCL, "/etc/sysconfig/varnish"] }
+                }
+            }
+        )
+
+    def add_alb(self, publicSubnetIds):
+        t = self.template
+        config = self.loadBalancerConfig
+
+        self.elb = t.add_resource(elbv2.LoadBalancer(
+            'Elb',
+            Type='application',
+            Scheme='internet-facing',
+            Subnets=publicSubnetIds,
+            SecurityGroups=[Ref(self.elbSg)],
+            LoadBalancerAttributes=[
+                elbv2.LoadBalancerAttributes(Key='routing.http2.enabled', Value='true'),
+                elbv2.LoadBalancerAttributes(
+                    Key='idle_timeout.timeout_seconds',
+                    Value=str(config.get('idleTimeout', 60))
+                )
+            ],
+            Tags=self.defaultTags + [
+                Tag('Name', Join("", [
+                    self.namePrefix,
+                    'Elb'
+                ]))
+            ]
+        ))
+
+        stickiness = config.get('stickiness', 0)
+        healthCheck = self.health_check_settings()
+        self.elbTargetGroup = t.add_resource(elbv2.TargetGroup(
+            'ElbTargetGroup',
+            VpcId=Ref(self.vpcIdParam),
+            Port=int(self.webPort),
+            Protocol='HTTP',
+            HealthCheckProtocol='HTTP',
+            HealthCheckPath=healthCheck['path'],
+            HealthCheckIntervalSeconds=healthCheck['interval'],
+            HealthCheckTimeoutSeconds=healthCheck['timeout'],
+            HealthyThresholdCount=healthCheck['healthyThreshold'],
+            UnhealthyThresholdCount=healthCheck['unhealthyThreshold'],
+            Matcher=elbv2.Matcher(HttpCode=healthCheck.get('httpCodes', '200')),
+            TargetGroupAttributes=[
+                elbv2.TargetGroupAttribute(
+                    Key='deregistration_delay.timeout_seconds',
+                    Value=str(config.get('deregistrationDelay', 30))
+                ),
+                elbv2.TargetGroupAttribute(
+                    Key='slow_start.duration_seconds',
+                    Value=str(config.get('slowStart', 0))
+                ),
+                # Stickiness is given as the cookie duration in seconds, 0 disables it.
+                elbv2.TargetGroupAttribute(
+                    Key='stickiness.enabled',
+                    Value='true' if stickiness else 'false'
+                ),
+                elbv2.TargetGroupAttribute(
+                    Key='stickiness.type',
+                    Value='lb_cookie'
+                ),
+                elbv2.TargetGroupAttribute(
+                    Key='stickiness.lb_cookie.duration_seconds',
+                    Value=str(stickiness or 86400)
+                )
+            ],
+            Tags=self.defaultTags + [
+                Tag('Name', Join("", [
+                    self.namePrefix,
+                    'ElbTargetGroup'
+                ]))
+            ]
+        ))
+
+        forward = elbv2.Action(
+            Type='forward',
+            TargetGroupArn=Ref(self.elbTargetGroup)
+        )
+
+        self.elbHttpsListener = t.add_resource(elbv2.Listener(
+            'ElbHttpsListener',
+            LoadBalancerArn=Ref(self.elb),
+            Port=443,
+            Protocol='HTTPS',
+            SslPolicy=config.get('sslPolicy', 'ELBSecurityPolicy-TLS-1-2-2017-01'),
+            Certificates=[elbv2.Certificate(CertificateArn=Ref(self.certificateArnParam))],
+            DefaultActions=[forward]
+        ))
+
+        # Plain HTTP is redirected to HTTPS, unless CloudFront is in front
+        # as it already redirects viewers and talks HTTP to the origin.
+        if self.sceptreUserData.get('cdn') is not None:
+            httpAction = forward
+        else:
+            httpAction = elbv2.Action(
+                Type='redirect',
+                RedirectConfig=elbv2.RedirectConfig(
+                    Protocol='HTTPS',
+                    Port='443',
+                    StatusCode='HTTP_301'
+                )
+            )
+
+        self.elbHttpListener = t.add_resource(elbv2.Listener(
+            'ElbHttpListener',
+            LoadBalancerArn=Ref(self.elb),
+            Port=80,
+            Protocol='HTTP',
+            DefaultActions=[httpAction]
+        ))
+        return 0
 
     def add_security_groups(self):
         t = self.template
@@ -190,8 +811,8 @@ class Wordpress(object):
             GroupDescription='Security group for ASG.',
             SecurityGroupIngress=[
                 SecurityGroupRule(
-                    ToPort='80',
-                    FromPort='80',
+                    ToPort=self.webPort,
+                    FromPort=self.webPort,
                     IpProtocol='tcp',
                     SourceSecurityGroupId=Ref(self.elbSg)
                 ),
@@ -201,7 +822,8 @@ class Wordpress(object):
                     IpProtocol='tcp',
                     SourceSecurityGroupId=Ref(self.vpnSgIdParam)
                 )
-                #TODO HTTPS
+                # HTTPS is terminated on the load balancer so only HTTP
+                # reaches the instances.
             ],
             Tags=self.defaultTags + [
                 Tag('Name', Join("", [
@@ -211,6 +833,18 @@ class Wordpress(object):
             ]
         ))
 
+        if self.pageCache:
+            # Only the web servers can purge each other's page caches
+            purgePort = str(self.pageCache['purgePort'])
+            t.add_resource(ec2.SecurityGroupIngress(
+                'AsgPurgeIngress',
+                GroupId=Ref(self.asgSg),
+                ToPort=purgePort,
+                FromPort=purgePort,
+                IpProtocol='tcp',
+                SourceSecurityGroupId=Ref(self.asgSg)
+            ))
+
         self.rdsSg = t.add_resource(SecurityGroup(
             'RdsSg',
             VpcId=Ref(self.vpcIdParam),
@@ -236,10 +870,7 @@ class Wordpress(object):
     def add_rds(self):
         t = self.template
 
-        dbSubnetIds = [ self.sceptreUserData['subnets']['privateDataAZ1Id'],
-                        self.sceptreUserData['subnets']['privateDataAZ2Id'],
-                        self.sceptreUserData['subnets']['privateDataAZ3Id']
-        ]
+        dbSubnetIds = self.subnet_ids('privateData')
 
         self.rdsSubnetGroup = t.add_resource(DBSubnetGroup(
             'DbSubnetGroup',
@@ -253,250 +884,1102 @@ class Wordpress(object):
             ]
         ))
 
+        databaseConfig = self.sceptreUserData.get('database', {})
+        engine = databaseConfig.get('engine', 'mysql')
+        self.rdsCluster = None
+        if engine == 'aurora-mysql':
+            return self.add_aurora(databaseConfig, dbSubnetIds)
+        if engine != 'mysql':
+            raise ValueError("Unknown database engine '{}', must be mysql or aurora-mysql".format(engine))
+        # engineVersion in the database block overrides the profile's for
+        # one stack. RDS only upgrades one major version at a time and only
+        # with allowMajorVersionUpgrade, read replicas have to be upgraded
+        # before their source so they are removed for each step.
+        self.dbEngineVersion = str(databaseConfig.get('engineVersion',
+            self.capacity.get('dbEngineVersion', DB_ENGINE_VERSION)))
+        allowMajorVersionUpgrade = databaseConfig.get('allowMajorVersionUpgrade', False)
+        if allowMajorVersionUpgrade and databaseConfig.get('readReplicas', 0):
+            raise ValueError("Set readReplicas to 0 while allowMajorVersionUpgrade is on, "
+                             "RDS upgrades read replicas before their source")
+
         self.rds = t.add_resource(DBInstance(
             'RdsInstance',
             AllocatedStorage=Ref(self.dbStorageParam),
-            DBInstanceClass='db.t2.micro',
+            DBInstanceClass=self.capacity['dbInstanceClass'],
+            StorageType=self.capacity['dbStorageType'],
             DBName=Ref(self.dbNameParam),
             DBSubnetGroupName=Ref(self.rdsSubnetGroup),
             VPCSecurityGroups=[Ref(self.rdsSg)],
             Engine='MySQL',
-            EngineVersion='5.5.46',
+            EngineVersion=self.dbEngineVersion,
             MasterUsername=Ref(self.dbUserParam),
             MasterUserPassword=Ref(self.dbPasswordParam),
-            MultiAZ=Ref(self.dbMultiAzParam)
+            MultiAZ=Ref(self.dbMultiAzParam),
+            # A final snapshot is kept if the database is ever deleted or
+            # replaced, e.g. when switching to the aurora-mysql engine.
+            DeletionPolicy='Snapshot',
+            UpdateReplacePolicy='Snapshot'
         ))
+        if self.capacity['dbStorageType'] == 'io1':
+            self.rds.Iops = self.capacity['dbIops']
+        if allowMajorVersionUpgrade:
+            self.rds.AllowMajorVersionUpgrade = True
+        self.dbHost = GetAtt(self.rds, "Endpoint.Address")
+
+        # Read replicas are spread over the AZs of the privateData subnets.
+        self.rdsReplicas = []
+        for i in range(0, databaseConfig.get('readReplicas', 0)):
+            replicaNum = str(i+1)
+            self.rdsReplicas.append(t.add_resource(DBInstance(
+                'RdsReadReplica'+replicaNum,
+                SourceDBInstanceIdentifier=Ref(self.rds),
+                Engine='MySQL',
+                DBInstanceClass=databaseConfig.get('replicaClass', self.capacity['dbInstanceClass']),
+                AvailabilityZone=Select(i % len(dbSubnetIds), GetAZs()),
+                VPCSecurityGroups=[Ref(self.rdsSg)],
+                Tags=self.defaultTags + [
+                    Tag('Name', Join("", [
+                        self.namePrefix,
+                        'RdsReadReplica'+replicaNum
+                    ]))
+                ]
+            )))
+        self.dbReadHosts = [GetAtt(replica, "Endpoint.Address") for replica in self.rdsReplicas]
         return 0
 
-    def add_autoscaling_group(self):
+    def add_aurora(self, databaseConfig, dbSubnetIds):
+        # Switching an existing stack from mysql replaces RdsInstance with
+        # an empty cluster. The MySQL instance leaves a final snapshot, the
+        # data has to be migrated into the cluster from it.
         t = self.template
 
-        self.asgLaunchConfig = t.add_resource(LaunchConfiguration(
-            'ASGLaunchConfig',
-            ImageId='ami-0b33d91d', #TODO Mapping for different regions
-            InstanceMonitoring=False,
-            AssociatePublicIpAddress=False,
-            InstanceType="t2.micro",
-            SecurityGroups=[Ref(self.asgSg)],
-            KeyName=Ref(self.keyPairParam),
-            UserData=Base64(Join("",
-                [
-                    "#!/bin/bash -xe\n",
-                    "yum update -y aws-cfn-bootstrap\n",
-
-                    "/opt/aws/bin/cfn-init -v ",
-                    "         --stack ", { "Ref" : "AWS::StackName" },
-                    "         --resource LaunchConfig ",
-                    "         --configsets wordpress_install ",
-                    "         --region ", { "Ref" : "AWS::Region" }, "\n",
-
-                    # "/opt/aws/bin/cfn-signal -e $? ",
-                    # "         --stack ", { "Ref" : "AWS::StackName" },
-                    # "         --resource WebServerGroup ",
-                    # "         --region ", { "Ref" : "AWS::Region" }, "\n"
+        instanceClass = databaseConfig.get('instanceClass', self.capacity['dbInstanceClass'])
+        if instanceClass.endswith('.micro'):
+            raise ValueError("Aurora MySQL doesn't run on {}, set the database instanceClass".format(instanceClass))
+        engineVersion = databaseConfig.get('engineVersion', AURORA_ENGINE_VERSION)
+        self.dbEngineVersion = engineVersion
+        clusterParameters = dict(AURORA_CLUSTER_PARAMETERS)
+        clusterParameters.update(databaseConfig.get('clusterParameters', {}))
+
+        self.rdsClusterParameterGroup = t.add_resource(DBClusterParameterGroup(
+            'DbClusterParameterGroup',
+            Description='Cluster parameter group for Aurora MySQL.',
+            Family='aurora-mysql8.0' if engineVersion.startswith('8.0') else 'aurora-mysql5.7',
+            Parameters=clusterParameters,
+            Tags=self.defaultTags + [
+                Tag('Name', Join("", [
+                    self.namePrefix,
+                    'DbClusterParameterGroup'
+                ]))
+            ]
+        ))
+
+        self.rdsCluster = t.add_resource(DBCluster(
+            'RdsCluster',
+            Engine='aurora-mysql',
+            EngineVersion=engineVersion,
+            DatabaseName=Ref(self.dbNameParam),
+            MasterUsername=Ref(self.dbUserParam),
+            MasterUserPassword=Ref(self.dbPasswordParam),
+            DBSubnetGroupName=Ref(self.rdsSubnetGroup),
+            DBClusterParameterGroupName=Ref(self.rdsClusterParameterGroup),
+            VpcSecurityGroupIds=[Ref(self.rdsSg)],
+            DeletionPolicy='Snapshot',
+            UpdateReplacePolicy='Snapshot',
+            Tags=self.defaultTags + [
+                Tag('Name', Join("", [
+                    self.namePrefix,
+                    'RdsCluster'
+                ]))
+            ]
+        ))
+
+        # The writer, storage is managed by the cluster
+        self.rds = t.add_resource(DBInstance(
+            'RdsInstance',
+            Engine='aurora-mysql',
+            DBClusterIdentifier=Ref(self.rdsCluster),
+            DBInstanceClass=instanceClass,
+            DBSubnetGroupName=Ref(self.rdsSubnetGroup),
+            Tags=self.defaultTags + [
+                Tag('Name', Join("", [
+                    self.namePrefix,
+                    'RdsInstance'
+                ]))
+            ]
+        ))
+        self.dbHost = GetAtt(self.rdsCluster, "Endpoint.Address")
+
+        # Readers are spread over the AZs of the privateData subnets, the
+        # reader endpoint balances connections over them and any added by
+        # auto scaling.
+        readers = databaseConfig.get('readReplicas', 1)
+        maxReaders = databaseConfig.get('maxReadReplicas', readers)
+        if not readers <= maxReaders <= AURORA_MAX_READERS:
+            raise ValueError("Aurora needs readReplicas {} <= maxReadReplicas {} <= {}".format(
+                readers, maxReaders, AURORA_MAX_READERS))
+        self.rdsReplicas = []
+        for i in range(0, readers):
+            replicaNum = str(i+1)
+            self.rdsReplicas.append(t.add_resource(DBInstance(
+                'RdsReadReplica'+replicaNum,
+                Engine='aurora-mysql',
+                DBClusterIdentifier=Ref(self.rdsCluster),
+                DBInstanceClass=databaseConfig.get('replicaClass', instanceClass),
+                DBSubnetGroupName=Ref(self.rdsSubnetGroup),
+                AvailabilityZone=Select(i % len(dbSubnetIds), GetAZs()),
+                # Readers can't be created before the writer
+                DependsOn=[self.rds.title],
+                Tags=self.defaultTags + [
+                    Tag('Name', Join("", [
+                        self.namePrefix,
+                        'RdsReadReplica'+replicaNum
+                    ]))
                 ]
-            )),
-            Metadata=cfn.Metadata(
-                cfn.Init(
-                    cfn.InitConfigSets(
-                        wordpress_install=['install_cfn', 'install_chefdk', "install_chef", "install_wordpress", "run_chef"]
-                    ),
-                    install_cfn=cfn.InitConfig(
-                        # Starts cfn-hup daemon which detects changes in metadata
-                        # and runs user-specified actions when a change is detected.
-                        # This allows configuration updates through UpdateStack.
-                        # The cfn-hup.conf file stores the name of the stack and
-                        # the AWS credentials that the cfn-hup daemon targets.
-                        # The cfn-hup daemon parses and loads each file in the /etc/cfn/hooks.d directory.
-                        files={
-                            "/etc/cfn/cfn-hup.conf": {
-                                "content": { "Fn::Join": [ "", [
-                                    "[main]\n",
-                                    "stack=", { "Ref": "AWS::StackId" }, "\n",
-                                    "region=", { "Ref": "AWS::Region" }, "\n"
-                                ]]},
-                                "mode"  : "000400",
-                                "owner" : "root",
-                                "group" : "root"
-                            },
-                            "/etc/cfn/hooks.d/cfn-auto-reloader.conf": {
-                                "content": { "Fn::Join": [ "", [
-                                    "[cfn-auto-reloader-hook]\n",
-                                    "triggers=post.update\n",
-                                    "path=Resources.LaunchConfig.Metadata.AWS::CloudFormation::Init\n",
-                                    "action=/opt/aws/bin/cfn-init -v ",
-                                    "         --stack ", { "Ref" : "AWS::StackName" },
-                                    "         --resource LaunchConfig ",
-                                    "         --configsets wordpress_install ",
-                                    "         --region ", { "Ref" : "AWS::Region" }, "\n"
-                                ]]},
-                                "mode"  : "000400",
-                                "owner" : "root",
-                                "group" : "root"
-                            }
-                        },
-                        services={
-                            "sysvinit" : {
-                                "cfn-hup" : { "enabled" : "true", "ensureRunning" : "true",
-                                "files" : ["/etc/cfn/cfn-hup.conf", "/etc/cfn/hooks.d/cfn-auto-reloader.conf"] }
-                            }
-                        }
-                    ),
-                    install_chefdk=cfn.InitConfig(
-                        packages={
-                            "rpm" : {
-                                "chefdk" : "https://opscode-omnibus-packages.s3.amazonaws.com/el/6/x86_64/chefdk-0.2.0-2.el6.x86_64.rpm"
-                            }
-                        }
-                    ),
-                    install_chef=cfn.InitConfig(
-                        sources={
-                            #  Set up a local Chef repository on the instance.
-                            "/var/chef/chef-repo" : "http://github.com/opscode/chef-repo/tarball/master"
-                        },
-                        files={
-                            #  Chef installation file.
-                            "/tmp/install.sh" : {
-                                "source" : "https://www.opscode.com/chef/install.sh",
-                                "mode"  : "000400",
-                                "owner" : "root",
-                                "group" : "root"
-                            },
-                            # Knife configuration file.
-                            "/var/chef/chef-repo/.chef/knife.rb" : {
-                                "content" : { "Fn::Join": [ "", [
-                                    "cookbook_path [ '/var/chef/chef-repo/cookbooks' ]\n",
-                                    "node_path [ '/var/chef/chef-repo/nodes' ]\n"
-                                ]]},
-                                "mode"  : "000400",
-                                "owner" : "root",
-                                "group" : "root"
-                            },
-                            # Chef client configuration file.
-                            "/var/chef/chef-repo/.chef/client.rb" : {
-                                "content" : { "Fn::Join": [ "", [
-                                    "cookbook_path [ '/var/chef/chef-repo/cookbooks' ]\n",
-                                    "node_path [ '/var/chef/chef-repo/nodes' ]\n"
-                                ]]},
-                                "mode"  : "000400",
-                                "owner" : "root",
-                                "group" : "root"
-                            }
-                        },
-                        commands={
-                            #  make the /var/chef directory readable, run the
-                            # Chef installation, and then start Chef local mode
-                            # by using the client.rb file that was created.
-                            # The commands are run in alphanumeric order.
-                            "01_make_chef_readable" : {
-                                "command" : "chmod +rx /var/chef"
-                            },
-                            "02_install_chef" : {
-                                "command" : "bash /tmp/install.sh",
-                                "cwd"  : "/var/chef"
-                            },
-                            "03_create_node_list" : {
-                                "command" : "chef-client -z -c /var/chef/chef-repo/.chef/client.rb",
-                                "cwd" : "/var/chef/chef-repo",
-                                "env" : { "HOME" : "/var/chef" }
-                            }
-                        }
-                    ),
-                    install_wordpress=cfn.InitConfig(
-                        # Installs WordPress by using a WordPress cookbook.
-                        files={
-                            # knife.rb and client.rb files are overwritten to
-                            # point to the cookbooks that are required to install WordPress.
-                            "/var/chef/chef-repo/.chef/knife.rb" : {
-                                "content" : { "Fn::Join": [ "", [
-                                    "cookbook_path [ '/var/chef/chef-repo/cookbooks/wordpress/berks-cookbooks' ]\n",
-                                    "node_path [ '/var/chef/chef-repo/nodes' ]\n"
-                                ]]},
-                                "mode"  : "000400",
-                                "owner" : "root",
-                                "group" : "root"
-                            },
-                            "/var/chef/chef-repo/.chef/client.rb" : {
-                                "content" : { "Fn::Join": [ "", [
-                                    "cookbook_path [ '/var/chef/chef-repo/cookbooks/wordpress/berks-cookbooks' ]\n",
-                                    "node_path [ '/var/chef/chef-repo/nodes' ]\n"
-                                ]]},
-                                "mode"  : "000400",
-                                "owner" : "root",
-                                "group" : "root"
-                            },
-                            #  Specify the Amazon RDS database instance as the WordPress database
-                            "/var/chef/chef-repo/cookbooks/wordpress/attributes/aws_rds_config.rb" : {
-                                "content": { "Fn::Join": [ "", [
-                                    "normal['wordpress']['db']['pass'] = '", Ref(self.dbPasswordParam), "'\n",
-                                    "normal['wordpress']['db']['user'] = '", Ref(self.dbUserParam), "'\n",
-                                    "normal['wordpress']['db']['host'] = '", GetAtt(self.rds, "Endpoint.Address"), "'\n",
-                                    "normal['wordpress']['db']['name'] = '", Ref(self.dbNameParam), "'\n"
-                                ]]},
-                                "mode"  : "000400",
-                                "owner" : "root",
-                                "group" : "root"
-                            }
-                        },
-                        commands={
-                            "01_get_cookbook" : {
-                                "command" : "knife cookbook site download wordpress",
-                                "cwd" : "/var/chef/chef-repo",
-                                "env" : { "HOME" : "/var/chef" }
-                            },
-                            "02_unpack_cookbook" : {
-                                "command" : "tar xvfz /var/chef/chef-repo/wordpress*",
-                                "cwd" : "/var/chef/chef-repo/cookbooks"
-                            },
-                            "03_init_berkshelf": {
-                                "command" : "berks init /var/chef/chef-repo/cookbooks/wordpress --skip-vagrant --skip-git",
-                                "cwd" : "/var/chef/chef-repo/cookbooks/wordpress",
-                                "env" : { "HOME" : "/var/chef" }
-                            },
-                            "04_vendorize_berkshelf" : {
-                                "command" : "berks vendor",
-                                "cwd" : "/var/chef/chef-repo/cookbooks/wordpress",
-                                "env" : { "HOME" : "/var/chef" }
-                            },
-                            "05_configure_node_run_list" : {
-                                "command" : "knife node run_list add -z `knife node list -z` recipe[wordpress]",
-                                "cwd" : "/var/chef/chef-repo",
-                                "env" : { "HOME" : "/var/chef" }
-                            }
-                        }
+            )))
+        self.dbReadHosts = [GetAtt(self.rdsCluster, "ReadEndpoint.Address")] if readers else []
 
-                    ),
-                    run_chef=cfn.InitConfig(
-                        commands={
-                            "01_run_chef_client" : {
-                                "command" : "chef-client -z -c /var/chef/chef-repo/.chef/client.rb",
-                                "cwd" : "/var/chef/chef-repo",
-                                "env" : { "HOME" : "/var/chef" }
-                            }
-                        }
-                    )
+        if maxReaders > readers:
+            if not readers:
+                raise ValueError("Aurora reader auto scaling needs at least one readReplica")
+            self.add_reader_scaling(databaseConfig.get('readerScaling', {}), readers, maxReaders)
+        return 0
+
+    def add_reader_scaling(self, scalingConfig, minReaders, maxReaders):
+        t = self.template
+        metric = scalingConfig.get('metric', 'cpu')
+        if metric not in AURORA_READER_METRICS:
+            raise ValueError("Unknown reader scaling metric '{}', must be one of {}".format(
+                metric, ', '.join(sorted(AURORA_READER_METRICS))))
+        metricType, defaultTarget = AURORA_READER_METRICS[metric]
+
+        # Application Auto Scaling adds and removes readers beyond the
+        # ones in this template, which count towards the minimum.
+        self.rdsReaderScalableTarget = t.add_resource(appscaling.ScalableTarget(
+            'RdsReaderScalableTarget',
+            ServiceNamespace='rds',
+            ScalableDimension='rds:cluster:ReadReplicaCount',
+            ResourceId=Join(':', ['cluster', Ref(self.rdsCluster)]),
+            MinCapacity=minReaders,
+            MaxCapacity=maxReaders,
+            RoleARN=Join('', [
+                'arn:aws:iam::', Ref('AWS::AccountId'),
+                ':role/aws-service-role/rds.application-autoscaling.amazonaws.com/'
+                'AWSServiceRoleForApplicationAutoScaling_RDSCluster'
+            ]),
+            DependsOn=[replica.title for replica in self.rdsReplicas]
+        ))
+        self.rdsReaderScalingPolicy = t.add_resource(appscaling.ScalingPolicy(
+            'RdsReaderScalingPolicy',
+            PolicyName=Join('-', [Ref('AWS::StackName'), 'RdsReaderScaling']),
+            PolicyType='TargetTrackingScaling',
+            ScalingTargetId=Ref(self.rdsReaderScalableTarget),
+            TargetTrackingScalingPolicyConfiguration=appscaling.TargetTrackingScalingPolicyConfiguration(
+                PredefinedMetricSpecification=appscaling.PredefinedMetricSpecification(
+                    PredefinedMetricType=metricType
+                ),
+                TargetValue=float(scalingConfig.get('targetValue', defaultTarget)),
+                ScaleInCooldown=scalingConfig.get('scaleInCooldown', 300),
+                ScaleOutCooldown=scalingConfig.get('scaleOutCooldown', 300),
+                DisableScaleIn=scalingConfig.get('disableScaleIn', False)
+            )
+        ))
+        return 0
+
+    def db_split_files(self, installDriver=True):
+        # HyperDB sends writes to the primary and spreads reads over the
+        # replicas, only reading from the primary if none are available.
+        # Baked AMIs already have its db.php drop-in.
+        dbConfig = [
+            "<?php\n",
+            "$wpdb->save_queries = false;\n",
+            "$wpdb->persistent = false;\n",
+            "$wpdb->check_tcp_responsiveness = true;\n",
+            "$wpdb->add_database(array(\n",
+            "    'host' => '", self.dbHost, "',\n",
+            "    'user' => DB_USER,\n",
+            "    'password' => DB_PASSWORD,\n",
+            "    'name' => DB_NAME,\n",
+            "    'write' => 1,\n",
+            "    'read' => 2,\n",
+            "));\n"
+        ]
+        for readHost in self.dbReadHosts:
+            dbConfig += [
+                "$wpdb->add_database(array(\n",
+                "    'host' => '", readHost, "',\n",
+                "    'user' => DB_USER,\n",
+                "    'password' => DB_PASSWORD,\n",
+                "    'name' => DB_NAME,\n",
+                "    'write' => 0,\n",
+                "    'read' => 1,\n",
+                "));\n"
+            ]
+        files = {
+            WORDPRESS_DIR+"/db-config.php" : {
+                "content" : { "Fn::Join": [ "", dbConfig ]},
+                "mode"  : "000644",
+                "owner" : "root",
+                "group" : "root"
+            }
+        }
+        if installDriver:
+            files[WORDPRESS_DIR+"/wp-content/db.php"] = {
+                "source" : "https://plugins.svn.wordpress.org/hyperdb/tags/{}/db.php".format(self.plugin_versions()['hyperdb']),
+                "mode"  : "000644",
+                "owner" : "root",
+                "group" : "root"
+            }
+        return files
+
+    def add_cache(self):
+        t = self.template
+        self.cache = None
+        cacheConfig = self.sceptreUserData.get('cache')
+        if cacheConfig is None:
+            return 0
+
+        engine = cacheConfig.get('engine', 'redis')
+        if engine not in CACHE_ENGINES:
+            raise ValueError("Unknown cache engine '{}', must be one of {}".format(
+                engine, ', '.join(sorted(CACHE_ENGINES))))
+        port, self.cacheEndpoint = CACHE_ENGINES[engine][:2]
+
+        self.cacheSg = t.add_resource(SecurityGroup(
+            'CacheSg',
+            VpcId=Ref(self.vpcIdParam),
+            GroupDescription='Security group for ElastiCache.',
+            SecurityGroupIngress=[
+                SecurityGroupRule(
+                    ToPort=port,
+                    FromPort=port,
+                    IpProtocol='tcp',
+                    SourceSecurityGroupId=Ref(self.asgSg)
+                )
+            ],
+            Tags=self.defaultTags + [
+                Tag('Name', Join("", [
+                    self.namePrefix,
+                    'CacheSg'
+                ]))
+            ]
+        ))
+
+        cacheSubnetIds = self.subnet_ids('privateData')
+
+        self.cacheSubnetGroup = t.add_resource(CacheSubnetGroup(
+            'CacheSubnetGroup',
+            Description='Subnet group for ElastiCache.',
+            SubnetIds=cacheSubnetIds
+        ))
+
+        self.cache = t.add_resource(CacheCluster(
+            'CacheCluster',
+            Engine=engine,
+            CacheNodeType=cacheConfig.get('nodeType', 'cache.t2.micro'),
+            # A redis cluster only has one node, and the memcached drop-in
+            # doesn't do auto discovery so would only use the node behind
+            # the configuration endpoint.
+            NumCacheNodes=1,
+            CacheSubnetGroupName=Ref(self.cacheSubnetGroup),
+            VpcSecurityGroupIds=[Ref(self.cacheSg)]
+        ))
+        self.cacheEngine = engine
+        return 0
+
+    def add_shared_content(self):
+        t = self.template
+        self.efs = None
+        self.efsMountTargets = []
+        efsConfig = self.sceptreUserData.get('sharedContent')
+        if efsConfig is None:
+            return 0
+
+        self.efsSg = t.add_resource(SecurityGroup(
+            'EfsSg',
+            VpcId=Ref(self.vpcIdParam),
+            GroupDescription='Security group for EFS.',
+            SecurityGroupIngress=[
+                SecurityGroupRule(
+                    ToPort='2049',
+                    FromPort='2049',
+                    IpProtocol='tcp',
+                    SourceSecurityGroupId=Ref(self.asgSg)
                 )
+            ],
+            Tags=self.defaultTags + [
+                Tag('Name', Join("", [
+                    self.namePrefix,
+                    'EfsSg'
+                ]))
+            ]
+        ))
+
+        self.efs = t.add_resource(FileSystem(
+            'Efs',
+            PerformanceMode=efsConfig.get('performanceMode', 'generalPurpose'),
+            ThroughputMode=efsConfig.get('throughputMode', 'bursting'),
+            Encrypted=True,
+            FileSystemTags=Tags(
+                Contact=Ref(self.ownerEmailParam),
+                Name=Join("", [self.namePrefix, 'Efs'])
             )
         ))
+        if efsConfig.get('throughputMode') == 'provisioned':
+            if 'provisionedThroughput' not in efsConfig:
+                raise ValueError("sharedContent throughputMode provisioned needs provisionedThroughput")
+            self.efs.ProvisionedThroughputInMibps = float(efsConfig['provisionedThroughput'])
 
-        webserverSubnetIds = [ self.sceptreUserData['subnets']['privateWebAZ1Id'],
-                            self.sceptreUserData['subnets']['privateWebAZ2Id'],
-                            self.sceptreUserData['subnets']['privateWebAZ3Id']
+        # One mount target in each of the web server subnets
+        webserverSubnetIds = self.subnet_ids('privateWeb')
+        for i, subnetId in enumerate(webserverSubnetIds):
+            self.efsMountTargets.append(t.add_resource(MountTarget(
+                'EfsMountTargetAZ'+str(i+1),
+                FileSystemId=Ref(self.efs),
+                SubnetId=subnetId,
+                SecurityGroups=[Ref(self.efsSg)]
+            )))
+        return 0
+
+    def shared_content_init_config(self):
+        # Mounts EFS over wp-content so every instance serves the same
+        # uploads, themes and plugins. Only an empty filesystem is seeded
+        # with the instance's own wp-content, later instances keep what's
+        # already there.
+        return cfn.InitConfig(
+            packages={
+                "yum" : { "nfs-utils" : [] }
+            },
+            commands={
+                "01_create_mount_points" : {
+                    "command" : "mkdir -p /mnt/efs "+WORDPRESS_DIR+"/wp-content"
+                },
+                "02_add_efs_to_fstab" : {
+                    "command" : { "Fn::Join": [ "", [
+                        "grep -q /mnt/efs /etc/fstab || echo '",
+                        Ref(self.efs), ".efs.", { "Ref" : "AWS::Region" }, ".amazonaws.com:/ /mnt/efs nfs4 ",
+                        EFS_MOUNT_OPTIONS+",_netdev 0 0' >> /etc/fstab"
+                    ]]}
+                },
+                "03_mount_efs" : {
+                    "command" : "mountpoint -q /mnt/efs || mount /mnt/efs"
+                },
+                "04_seed_wp_content" : {
+                    "command" : "[ -n \"$(ls -A /mnt/efs)\" ] || cp -a wp-content/. /mnt/efs/",
+                    "cwd" : WORDPRESS_DIR
+                },
+                "05_add_wp_content_to_fstab" : {
+                    "command" : "grep -q ' "+WORDPRESS_DIR+"/wp-content ' /etc/fstab || "
+                                "echo '/mnt/efs "+WORDPRESS_DIR+"/wp-content none bind 0 0' >> /etc/fstab"
+                },
+                "06_mount_wp_content" : {
+                    "command" : "mountpoint -q "+WORDPRESS_DIR+"/wp-content || mount "+WORDPRESS_DIR+"/wp-content"
+                }
+            }
+        )
+
+    def add_media_bucket(self):
+        t = self.template
+        self.mediaBucket = None
+        self.webServerPolicies = []
+        self.mediaConfig = self.sceptreUserData.get('mediaOffload')
+        if self.mediaConfig is None:
+            return 0
+        # The bucket is private, media is only served through CloudFront
+        if self.sceptreUserData.get('cdn') is None:
+            raise ValueError("mediaOffload needs cdn, the media bucket is only readable through CloudFront")
+
+        self.mediaBucket = t.add_resource(Bucket(
+            'MediaBucket',
+            PublicAccessBlockConfiguration=PublicAccessBlockConfiguration(
+                BlockPublicAcls=True,
+                BlockPublicPolicy=True,
+                IgnorePublicAcls=True,
+                RestrictPublicBuckets=True
+            ),
+            OwnershipControls=OwnershipControls(
+                Rules=[OwnershipControlsRule(ObjectOwnership='BucketOwnerEnforced')]
+            ),
+            Tags=Tags(
+                Contact=Ref(self.ownerEmailParam),
+                Name=Join("", [self.namePrefix, 'MediaBucket'])
+            )
+        ))
+
+        # Lets the web servers manage the media through their instance role
+        self.webServerPolicies.append(IAMPolicy(
+            PolicyName='MediaBucketAccess',
+            PolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [
+                    {
+                        "Effect": "Allow",
+                        "Action": ["s3:ListBucket", "s3:GetBucketLocation"],
+                        "Resource": [GetAtt(self.mediaBucket, 'Arn')]
+                    },
+                    {
+                        "Effect": "Allow",
+                        "Action": ["s3:GetObject", "s3:PutObject", "s3:DeleteObject"],
+                        "Resource": [Join("", [GetAtt(self.mediaBucket, 'Arn'), "/*"])]
+                    }
+                ]
+            }
+        ))
+        return 0
+
+    def add_monitoring(self):
+        t = self.template
+        # Opt in, adds 1 minute instance metrics, the CloudWatch agent, RDS
+        # enhanced monitoring and Performance Insights and a dashboard.
+        self.observability = self.sceptreUserData.get('observability')
+        if self.observability is None:
+            return 0
+
+        monitoringInterval = self.observability.get('rdsMonitoringInterval', 60)
+        if monitoringInterval not in [0, 1, 5, 10, 15, 30, 60]:
+            raise ValueError("rdsMonitoringInterval is {} but must be 0, 1, 5, 10, 15, 30 or 60".format(
+                monitoringInterval))
+        if monitoringInterval:
+            self.rdsMonitoringRole = t.add_resource(Role(
+                'RdsMonitoringRole',
+                AssumeRolePolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [{
+                        "Effect": "Allow",
+                        "Principal": { "Service": ["monitoring.rds.amazonaws.com"] },
+                        "Action": ["sts:AssumeRole"]
+                    }]
+                },
+                Path='/',
+                ManagedPolicyArns=['arn:aws:iam::aws:policy/service-role/AmazonRDSEnhancedMonitoringRole']
+            ))
+
+        # Performance Insights is only turned on when asked for, and the
+        # engine version and every instance class must support it.
+        performanceInsights = self.observability.get('performanceInsights', False)
+        self.performanceInsightsInstances = []
+        for instance in [self.rds] + self.rdsReplicas:
+            if monitoringInterval:
+                instance.MonitoringInterval = monitoringInterval
+                instance.MonitoringRoleArn = GetAtt(self.rdsMonitoringRole, 'Arn')
+            if performanceInsights and not self.performance_insights_supported(instance.DBInstanceClass):
+                raise ValueError("performanceInsights isn't supported by {} {} on {} used by {}".format(
+                    'Aurora MySQL' if self.rdsCluster else 'MySQL', self.dbEngineVersion,
+                    instance.DBInstanceClass, instance.title))
+            if performanceInsights:
+                instance.EnablePerformanceInsights = True
+                instance.PerformanceInsightsRetentionPeriod = self.observability.get('performanceInsightsRetention', 7)
+                self.performanceInsightsInstances.append(instance)
+
+        # Lets the CloudWatch agent publish metrics and tag them with the group
+        self.webServerPolicies.append(IAMPolicy(
+            PolicyName='CloudWatchAgent',
+            PolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [{
+                    "Effect": "Allow",
+                    "Action": ["cloudwatch:PutMetricData", "ec2:DescribeTags", "ec2:DescribeVolumes"],
+                    "Resource": ["*"]
+                }]
+            }
+        ))
+        return 0
+
+    def performance_insights_supported(self, instanceClass):
+        if instanceClass.endswith(('.micro', '.small')):
+            return False
+        if self.rdsCluster:
+            # Aurora MySQL doesn't support it on the burstable classes
+            return not instanceClass.startswith('db.t')
+        # RDS MySQL supports it from 5.7.22
+        version = tuple(int(part) for part in re.findall(r'\d+', self.dbEngineVersion)[:3])
+        return version >= (5, 7, 22)
+
+    def cloudwatch_agent_init_config(self):
+        # Memory, swap and disk use aren't visible to EC2, the web server
+        # processes are watched whether they are httpd or php-fpm.
+        processMeasurements = ["cpu_usage", "memory_rss", "pid_count"]
+        agentConfig = {
+            "agent": { "metrics_collection_interval": 60 },
+            "metrics": {
+                "append_dimensions": {
+                    "AutoScalingGroupName": "${aws:AutoScalingGroupName}",
+                    "InstanceId": "${aws:InstanceId}"
+                },
+                "aggregation_dimensions": [["AutoScalingGroupName"]],
+                "metrics_collected": {
+                    "mem": { "measurement": ["mem_used_percent"] },
+                    "swap": { "measurement": ["swap_used_percent"] },
+                    "disk": { "measurement": ["used_percent"], "resources": ["/"] },
+                    "procstat": [
+                        { "exe": "httpd", "measurement": processMeasurements },
+                        { "exe": "php-fpm", "measurement": processMeasurements }
+                    ]
+                }
+            }
+        }
+        return cfn.InitConfig(
+            packages={
+                "rpm" : {
+                    "amazon-cloudwatch-agent" : CLOUDWATCH_AGENT_RPM
+                }
+            },
+            files={
+                CLOUDWATCH_AGENT_CONFIG : {
+                    "content" : agentConfig,
+                    "mode"  : "000444",
+                    "owner" : "root",
+                    "group" : "root"
+                }
+            },
+            commands={
+                "01_start_cloudwatch_agent" : {
+                    "command" : "/opt/aws/amazon-cloudwatch-agent/bin/amazon-cloudwatch-agent-ctl "
+                                "-a fetch-config -m ec2 -s -c file:"+CLOUDWATCH_AGENT_CONFIG
+                }
+            }
+        )
+
+    def add_instance_role(self):
+        t = self.template
+        self.webServerInstanceProfile = None
+        if not self.webServerPolicies:
+            return 0
+
+        self.webServerRole = t.add_resource(Role(
+            'WebServerRole',
+            AssumeRolePolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [{
+                    "Effect": "Allow",
+                    "Principal": { "Service": ["ec2.amazonaws.com"] },
+                    "Action": ["sts:AssumeRole"]
+                }]
+            },
+            Path='/',
+            Policies=self.webServerPolicies
+        ))
+
+        self.webServerInstanceProfile = t.add_resource(InstanceProfile(
+            'WebServerInstanceProfile',
+            Path='/',
+            Roles=[Ref(self.webServerRole)]
+        ))
+        return 0
+
+    def media_constants(self):
+        # WP Offload Media settings, media is copied to the private bucket
+        # and served through CloudFront. Object ACLs are disabled on the
+        # bucket so the plugin mustn't set them.
+        settings = [
+            "serialize(array(",
+            "'provider' => 'aws', 'use-server-roles' => true, ",
+            "'bucket' => '", Ref(self.mediaBucket), "', ",
+            "'region' => '", { "Ref" : "AWS::Region" }, "', ",
+            "'copy-to-s3' => true, 'serve-from-s3' => true, ",
+            "'block-public-access' => true, 'object-ownership-enforced' => true, ",
+            "'remove-local-file' => {}, ".format('true' if self.mediaConfig.get('removeLocalFiles', True) else 'false'),
+            "'enable-delivery-domain' => true, ",
+            "'delivery-domain' => '", GetAtt(self.cdn, 'DomainName'), "'",
+            "))"
+        ]
+        return [
+            ('AS3CF_SETTINGS', Join("", settings), "")
+        ]
+
+    def media_init_config(self):
+        # Installs WP Offload Media as a must-use plugin so it is always active.
+        commands = self.plugin_download_commands('amazon-s3-and-cloudfront', 'media')
+        return cfn.InitConfig(
+            files={
+                WORDPRESS_DIR+"/wp-content/mu-plugins/media-offload.php" : {
+                    "content" : { "Fn::Join": [ "", [
+                        "<?php\n",
+                        "require WP_PLUGIN_DIR . '/amazon-s3-and-cloudfront/wordpress-s3.php';\n"
+                    ]]},
+                    "mode"  : "000644",
+                    "owner" : "root",
+                    "group" : "root"
+                }
+            },
+            commands=commands
+        )
+
+    def cache_constants(self):
+        # wp-config.php constants pointing the object cache at the cluster,
+        # as (name, value, quote) where quote wraps the value in the PHP.
+        constants = [
+            ('WP_CACHE_KEY_SALT', { "Ref" : "AWS::StackName" }, "'")
+        ]
+        if self.cacheEngine == 'redis':
+            constants += [
+                ('WP_REDIS_HOST', GetAtt(self.cache, "RedisEndpoint.Address"), "'"),
+                ('WP_REDIS_PORT', GetAtt(self.cache, "RedisEndpoint.Port"), "")
+            ]
+        return constants
+
+    def join_constant(self, prefix, value, suffix):
+        # Fn::Join fragments for a setting, kept as one string where possible.
+        if isinstance(value, str):
+            return [prefix + value + suffix]
+        return [prefix, value, suffix]
+
+    def chef_config_file(self, constants):
+        # Chef attributes which add the given constants to wp-config.php
+        settings = []
+        for name, value, quote in constants:
+            settings += self.join_constant(
+                "normal['wordpress']['wp_config_options']['{}'] = \"{}".format(name, quote),
+                value, quote + "\"\n")
+        return {
+            "content": { "Fn::Join": [ "", settings ]},
+            "mode"  : "000400",
+            "owner" : "root",
+            "group" : "root"
+        }
+
+    def plugin_versions(self):
+        versions = dict(PLUGIN_VERSIONS)
+        versions.update(self.sceptreUserData.get('pluginVersions', {}))
+        return versions
+
+    def plugin_download_commands(self, plugin, name):
+        # Commands downloading a pinned plugin version from wordpress.org
+        # into wp-content/plugins
+        versions = self.plugin_versions()
+        return {
+            "01_download_{}_plugin".format(name) : {
+                "command" : "curl -sSfL -o /tmp/{0}.zip https://downloads.wordpress.org/plugin/{0}.{1}.zip".format(
+                    plugin, versions[plugin])
+            },
+            "02_unpack_{}_plugin".format(name) : {
+                "command" : "unzip -o -q /tmp/{}.zip -d wp-content/plugins".format(plugin),
+                "cwd" : WORDPRESS_DIR
+            }
+        }
+
+    def cache_init_config(self):
+        # Installs the object-cache.php drop-in once WordPress is installed.
+        port, endpoint, plugin, dropin = CACHE_ENGINES[self.cacheEngine]
+        commands = self.plugin_download_commands(plugin, 'cache')
+        commands.update({
+            "03_install_cache_dropin" : {
+                "command" : "cp wp-content/plugins/{}/{} wp-content/object-cache.php".format(plugin, dropin),
+                "cwd" : WORDPRESS_DIR
+            }
+        })
+        packages = {}
+        if self.cacheEngine == 'memcached':
+            # The memcached drop-in reads its servers from a global rather
+            # than a constant so it is added to wp-config.php directly.
+            packages = { "yum" : { "php-pecl-memcache" : [] } }
+            commands["04_configure_memcached_servers"] = {
+                "command" : { "Fn::Join": [ "", [
+                    "grep -q memcached_servers wp-config.php || ",
+                    "sed -i \"/stop editing/i \\$memcached_servers = array('default' => array('",
+                    GetAtt(self.cache, "ConfigurationEndpoint.Address"), ":",
+                    GetAtt(self.cache, "ConfigurationEndpoint.Port"), "'));\" wp-config.php"
+                ]]},
+                "cwd" : WORDPRESS_DIR
+            }
+        return cfn.InitConfig(
+            packages=packages,
+            commands=commands
+        )
+
+    def cfn_init_config(self, resourceName):
+        return cfn.InitConfig(
+            # Starts cfn-hup daemon which detects changes in metadata
+            # and runs user-specified actions when a change is detected.
+            # This allows configuration updates through UpdateStack.
+            # The cfn-hup.conf file stores the name of the stack and
+            # the AWS credentials that the cfn-hup daemon targets.
+            # The cfn-hup daemon parses and loads each file in the /etc/cfn/hooks.d directory.
+            files={
+                "/etc/cfn/cfn-hup.conf": {
+                    "content": { "Fn::Join": [ "", [
+                        "[main]\n",
+                        "stack=", { "Ref": "AWS::StackId" }, "\n",
+                        "region=", { "Ref": "AWS::Region" }, "\n"
+                    ]]},
+                    "mode"  : "000400",
+                    "owner" : "root",
+                    "group" : "root"
+                },
+                "/etc/cfn/hooks.d/cfn-auto-reloader.conf": {
+                    "content": { "Fn::Join": [ "", [
+                        "[cfn-auto-reloader-hook]\n",
+                        "triggers=post.update\n",
+                        "path=Resources.", resourceName, ".Metadata.AWS::CloudFormation::Init\n",
+                        "action=/opt/aws/bin/cfn-init -v ",
+                        "         --stack ", { "Ref" : "AWS::StackName" },
+                        "         --resource ", resourceName, " ",
+                        "         --configsets wordpress_install ",
+                        "         --region ", { "Ref" : "AWS::Region" }, "\n"
+                    ]]},
+                    "mode"  : "000400",
+                    "owner" : "root",
+                    "group" : "root"
+                }
+            },
+            services={
+                "sysvinit" : {
+                    "cfn-hup" : { "enabled" : "true", "ensureRunning" : "true",
+                    "files" : ["/etc/cfn/cfn-hup.conf", "/etc/cfn/hooks.d/cfn-auto-reloader.conf"] }
+                }
+            }
+        )
+
+    def chef_init_configs(self):
+        # Installs WordPress from scratch with the wordpress chef cookbook.
+        wordpressFiles = {
+            # knife.rb and client.rb files are overwritten to
+            # point to the cookbooks that are required to install WordPress.
+            "/var/chef/chef-repo/.chef/knife.rb" : {
+                "content" : { "Fn::Join": [ "", [
+                    "cookbook_path [ '/var/chef/chef-repo/cookbooks/wordpress/berks-cookbooks' ]\n",
+                    "node_path [ '/var/chef/chef-repo/nodes' ]\n"
+                ]]},
+                "mode"  : "000400",
+                "owner" : "root",
+                "group" : "root"
+            },
+            "/var/chef/chef-repo/.chef/client.rb" : {
+                "content" : { "Fn::Join": [ "", [
+                    "cookbook_path [ '/var/chef/chef-repo/cookbooks/wordpress/berks-cookbooks' ]\n",
+                    "node_path [ '/var/chef/chef-repo/nodes' ]\n"
+                ]]},
+                "mode"  : "000400",
+                "owner" : "root",
+                "group" : "root"
+            },
+            #  Specify the Amazon RDS database instance as the WordPress database
+            "/var/chef/chef-repo/cookbooks/wordpress/attributes/aws_rds_config.rb" : {
+                "content": { "Fn::Join": [ "", [
+                    "normal['wordpress']['db']['pass'] = '", Ref(self.dbPasswordParam), "'\n",
+                    "normal['wordpress']['db']['user'] = '", Ref(self.dbUserParam), "'\n",
+                    "normal['wordpress']['db']['host'] = '", self.dbHost, "'\n",
+                    "normal['wordpress']['db']['name'] = '", Ref(self.dbNameParam), "'\n"
+                ]]},
+                "mode"  : "000400",
+                "owner" : "root",
+                "group" : "root"
+            }
+        }
+        if self.cache:
+            #  Point the WordPress object cache at the ElastiCache cluster
+            wordpressFiles["/var/chef/chef-repo/cookbooks/wordpress/attributes/aws_cache_config.rb"] = self.chef_config_file(self.cache_constants())
+
+        if self.mediaBucket:
+            #  Configure the media offload plugin with the S3 bucket
+            wordpressFiles["/var/chef/chef-repo/cookbooks/wordpress/attributes/aws_media_config.rb"] = self.chef_config_file(self.media_constants())
+
+        if self.dbReadHosts:
+            #  Split database reads and writes between the replicas and primary
+            wordpressFiles.update(self.db_split_files())
+
+        return {
+            "install_chefdk" : cfn.InitConfig(
+                packages={
+                    "rpm" : {
+                        "chefdk" : "https://opscode-omnibus-packages.s3.amazonaws.com/el/6/x86_64/chefdk-0.2.0-2.el6.x86_64.rpm"
+                    }
+                }
+            ),
+            "install_chef" : cfn.InitConfig(
+                sources={
+                    #  Set up a local Chef repository on the instance.
+                    "/var/chef/chef-repo" : "http://github.com/opscode/chef-repo/tarball/master"
+                },
+                files={
+                    #  Chef installation file.
+                    "/tmp/install.sh" : {
+                        "source" : "https://www.opscode.com/chef/install.sh",
+                        "mode"  : "000400",
+                        "owner" : "root",
+                        "group" : "root"
+                    },
+                    # Knife configuration file.
+                    "/var/chef/chef-repo/.chef/knife.rb" : {
+                        "content" : { "Fn::Join": [ "", [
+                            "cookbook_path [ '/var/chef/chef-repo/cookbooks' ]\n",
+                            "node_path [ '/var/chef/chef-repo/nodes' ]\n"
+                        ]]},
+                        "mode"  : "000400",
+                        "owner" : "root",
+                        "group" : "root"
+                    },
+                    # Chef client configuration file.
+                    "/var/chef/chef-repo/.chef/client.rb" : {
+                        "content" : { "Fn::Join": [ "", [
+                            "cookbook_path [ '/var/chef/chef-repo/cookbooks' ]\n",
+                            "node_path [ '/var/chef/chef-repo/nodes' ]\n"
+                        ]]},
+                        "mode"  : "000400",
+                        "owner" : "root",
+                        "group" : "root"
+                    }
+                },
+                commands={
+                    #  make the /var/chef directory readable, run the
+                    # Chef installation, and then start Chef local mode
+                    # by using the client.rb file that was created.
+                    # The commands are run in alphanumeric order.
+                    "01_make_chef_readable" : {
+                        "command" : "chmod +rx /var/chef"
+                    },
+                    "02_install_chef" : {
+                        "command" : "bash /tmp/install.sh",
+                        "cwd"  : "/var/chef"
+                    },
+                    "03_create_node_list" : {
+                        "command" : "chef-client -z -c /var/chef/chef-repo/.chef/client.rb",
+                        "cwd" : "/var/chef/chef-repo",
+                        "env" : { "HOME" : "/var/chef" }
+                    }
+                }
+            ),
+            "install_wordpress" : cfn.InitConfig(
+                # Installs WordPress by using a WordPress cookbook.
+                files=wordpressFiles,
+                commands={
+                    "01_get_cookbook" : {
+                        "command" : "knife cookbook site download wordpress",
+                        "cwd" : "/var/chef/chef-repo",
+                        "env" : { "HOME" : "/var/chef" }
+                    },
+                    "02_unpack_cookbook" : {
+                        "command" : "tar xvfz /var/chef/chef-repo/wordpress*",
+                        "cwd" : "/var/chef/chef-repo/cookbooks"
+                    },
+                    "03_init_berkshelf": {
+                        "command" : "berks init /var/chef/chef-repo/cookbooks/wordpress --skip-vagrant --skip-git",
+                        "cwd" : "/var/chef/chef-repo/cookbooks/wordpress",
+                        "env" : { "HOME" : "/var/chef" }
+                    },
+                    "04_vendorize_berkshelf" : {
+                        "command" : "berks vendor",
+                        "cwd" : "/var/chef/chef-repo/cookbooks/wordpress",
+                        "env" : { "HOME" : "/var/chef" }
+                    },
+                    "05_configure_node_run_list" : {
+                        "command" : "knife node run_list add -z `knife node list -z` recipe[wordpress]",
+                        "cwd" : "/var/chef/chef-repo",
+                        "env" : { "HOME" : "/var/chef" }
+                    }
+                }
+
+            ),
+            "run_chef" : cfn.InitConfig(
+                commands={
+                    "01_run_chef_client" : {
+                        "command" : "chef-client -z -c /var/chef/chef-repo/.chef/client.rb",
+                        "cwd" : "/var/chef/chef-repo",
+                        "env" : { "HOME" : "/var/chef" }
+                    }
+                }
+            )
+        }
+
+    def baked_init_configs(self):
+        # The baked AMI already has WordPress installed by the chef
+        # configsets, so only the settings for this stack are written and
+        # the web server is started.
+        awsConfig = ["<?php\n"]
+        constants = [
+            ('DB_NAME', Ref(self.dbNameParam), "'"),
+            ('DB_USER', Ref(self.dbUserParam), "'"),
+            ('DB_PASSWORD', Ref(self.dbPasswordParam), "'"),
+            ('DB_HOST', self.dbHost, "'")
         ]
+        if self.cache:
+            constants += self.cache_constants()
+        if self.mediaBucket:
+            constants += self.media_constants()
+        for name, value, quote in constants:
+            awsConfig += self.join_constant(
+                "defined('{0}') || define('{0}', {1}".format(name, quote), value, quote + ");\n")
+        if self.cache and self.cacheEngine == 'memcached':
+            # The memcached drop-in reads its servers from a global
+            awsConfig += [
+                "$memcached_servers = array('default' => array('",
+                GetAtt(self.cache, "ConfigurationEndpoint.Address"), ":",
+                GetAtt(self.cache, "ConfigurationEndpoint.Port"), "'));\n"
+            ]
+
+        wordpressFiles = {
+            WORDPRESS_DIR+"/wp-config-aws.php" : {
+                "content" : { "Fn::Join": [ "", awsConfig ]},
+                "mode"  : "000440",
+                "owner" : "root",
+                "group" : "apache"
+            }
+        }
+        if self.dbReadHosts:
+            #  Split database reads and writes between the replicas and primary
+            wordpressFiles.update(self.db_split_files(installDriver=False))
+
+        return {
+            "configure_wordpress" : cfn.InitConfig(
+                files=wordpressFiles,
+                commands={
+                    # Swap the stack settings the AMI was baked with for
+                    # the ones in wp-config-aws.php.
+                    "01_load_aws_config" : {
+                        "command" : "grep -q wp-config-aws.php wp-config.php || "
+                                    "sed -i -e \"/define('\\(" + "\\|".join(STACK_CONSTANTS) + "\\)'/d\" "
+                                    "-e \"/^\\$memcached_servers/d\" "
+                                    "-e \"/stop editing/i require_once(dirname(__FILE__) . '/wp-config-aws.php');\" wp-config.php",
+                        "cwd" : WORDPRESS_DIR
+                    }
+                },
+                services={
+                    "sysvinit" : {
+                        "httpd" : { "enabled" : "true", "ensureRunning" : "true",
+                        "files" : [WORDPRESS_DIR+"/wp-config-aws.php"] }
+                    }
+                }
+            )
+        }
+
+    def add_autoscaling_group(self):
+        t = self.template
+
+        # chef installs everything on boot, baked starts from an AMI which
+        # already has WordPress installed so instances are ready sooner.
+        bootMode = self.sceptreUserData.get('bootMode', 'chef')
+        if bootMode == 'chef':
+            configSets = ['install_cfn', 'install_chefdk', "install_chef", "install_wordpress", "run_chef"]
+            initConfigs = self.chef_init_configs()
+            bootstrap = ["yum update -y aws-cfn-bootstrap\n"]
+        elif bootMode == 'baked':
+            configSets = ['install_cfn', 'configure_wordpress']
+            initConfigs = self.baked_init_configs()
+            bootstrap = []
+        else:
+            raise ValueError("Unknown boot mode '{}', must be chef or baked".format(bootMode))
+        # The launch template replaces the launch configuration when
+        # instance types are mixed, cfn-init reads the metadata from it.
+        launchTemplateConfig = self.sceptreUserData.get('launchTemplate')
+        launchResourceName = 'WebServerLaunchTemplate' if launchTemplateConfig else 'ASGLaunchConfig'
+        initConfigs['install_cfn'] = self.cfn_init_config(launchResourceName)
+
+        # As with every optional block, an empty phpTuning key leaves it
+        # off and {} tunes with the defaults.
+        phpTuningConfig = self.sceptreUserData.get('phpTuning')
+        if phpTuningConfig is not None:
+            configSets.append('tune_php')
+            initConfigs['tune_php'] = self.php_tuning_init_config(phpTuningConfig)
+
+        if self.efs:
+            # chef installs WordPress in run_chef, so wp-content is only
+            # mounted afterwards to seed an empty filesystem with it. The
+            # baked AMI already has it, so it's mounted before configuring.
+            if bootMode == 'chef':
+                configSets.insert(configSets.index('run_chef') + 1, 'mount_wp_content')
+            else:
+                configSets.insert(1, 'mount_wp_content')
+            initConfigs['mount_wp_content'] = self.shared_content_init_config()
+
+        if self.pageCache:
+            configSets.append('install_page_cache')
+            initConfigs['install_page_cache'] = self.page_cache_init_config()
+
+        # The baked AMI already has the plugins and drop-ins, the baked
+        # configset only writes their settings.
+        if self.cache and bootMode == 'chef':
+            configSets.append('install_object_cache')
+            initConfigs['install_object_cache'] = self.cache_init_config()
+
+        if self.mediaBucket and bootMode == 'chef':
+            configSets.append('install_media_offload')
+            initConfigs['install_media_offload'] = self.media_init_config()
+
+        if self.observability is not None:
+            configSets.append('install_cloudwatch_agent')
+            initConfigs['install_cloudwatch_agent'] = self.cloudwatch_agent_init_config()
+
+        # A .php health check path is a page cfn-init provides, any other
+        # path is expected to be served by WordPress itself.
+        if self.health_check_settings()['path'].endswith('.php'):
+            configSets.append('install_health_check')
+            initConfigs['install_health_check'] = self.health_check_init_config()
+
+        userData = Base64(Join("",
+            ["#!/bin/bash -xe\n"] + bootstrap + [
+                # The exit code is kept so a failed cfn-init is
+                # signalled rather than stopping the script.
+                "cfnInitStatus=0\n",
+                "/opt/aws/bin/cfn-init -v ",
+                "         --stack ", { "Ref" : "AWS::StackName" },
+                "         --resource ", launchResourceName, " ",
+                "         --configsets wordpress_install ",
+                "         --region ", { "Ref" : "AWS::Region" },
+                " || cfnInitStatus=$?\n",
+
+                "/opt/aws/bin/cfn-signal -e $cfnInitStatus ",
+                "         --stack ", { "Ref" : "AWS::StackName" },
+                "         --resource WebServerASG ",
+                "         --region ", { "Ref" : "AWS::Region" }, "\n"
+            ]
+        ))
+        metadata = cfn.Metadata(
+            cfn.Init(
+                cfn.InitConfigSets(
+                    wordpress_install=configSets
+                ),
+                **initConfigs
+            )
+        )
+
+        self.asgLaunchConfig = None
+        self.launchTemplate = None
+        if launchTemplateConfig:
+            self.launchTemplate = t.add_resource(ec2.LaunchTemplate(
+                launchResourceName,
+                LaunchTemplateData=ec2.LaunchTemplateData(
+                    ImageId=Ref(self.amiIdParam),
+                    Monitoring=ec2.Monitoring(Enabled=self.observability is not None),
+                    InstanceType=self.capacity['webInstanceType'],
+                    SecurityGroupIds=[Ref(self.asgSg)],
+                    KeyName=Ref(self.keyPairParam),
+                    UserData=userData
+                ),
+                Metadata=metadata
+            ))
+            if 'cpuCredits' in launchTemplateConfig:
+                # unlimited stops burstable types throttling once out of credits
+                self.launchTemplate.LaunchTemplateData.CreditSpecification = ec2.LaunchTemplateCreditSpecification(
+                    CpuCredits=launchTemplateConfig['cpuCredits']
+                )
+            if self.webServerInstanceProfile:
+                self.launchTemplate.LaunchTemplateData.IamInstanceProfile = ec2.IamInstanceProfile(
+                    Arn=GetAtt(self.webServerInstanceProfile, 'Arn')
+                )
+        else:
+            self.asgLaunchConfig = t.add_resource(LaunchConfiguration(
+                launchResourceName,
+                ImageId=Ref(self.amiIdParam),
+                InstanceMonitoring=self.observability is not None,
+                AssociatePublicIpAddress=False,
+                InstanceType=self.capacity['webInstanceType'],
+                SecurityGroups=[Ref(self.asgSg)],
+                KeyName=Ref(self.keyPairParam),
+                UserData=userData,
+                Metadata=metadata
+            ))
+            if self.webServerInstanceProfile:
+                self.asgLaunchConfig.IamInstanceProfile = Ref(self.webServerInstanceProfile)
+
+        webserverSubnetIds = self.subnet_ids('privateWeb')
 
         self.webServerASG = t.add_resource(AutoScalingGroup(
             'WebServerASG',
-            LaunchConfigurationName=Ref(self.asgLaunchConfig),
-            LoadBalancerNames=[Ref(self.elb)],
-            MinSize='1',
-            DesiredCapacity='2',
-            Cooldown='1',
-            MaxSize='5',
-            UpdatePolicy = UpdatePolicy(
-                    AutoScalingRollingUpdate=AutoScalingRollingUpdate(
-                    MinInstancesInService="1"
-                )
-            ),
+            MinSize=str(self.capacity['asgMinSize']),
+            DesiredCapacity=str(self.capacity['asgDesiredCapacity']),
+            MaxSize=str(self.capacity['asgMaxSize']),
+            UpdatePolicy=self.build_update_policy(),
+            CreationPolicy=self.build_creation_policy(),
             VPCZoneIdentifier=webserverSubnetIds,
             Tags=[
                 ASTag('Contact', Ref(self.ownerEmailParam), True),
@@ -507,23 +1990,649 @@ class Wordpress(object):
             ]
         ))
 
+        if self.launchTemplate:
+            self.webServerASG.MixedInstancesPolicy = self.build_mixed_instances_policy(launchTemplateConfig)
+            # Spot instances due to be interrupted are replaced ahead of time
+            self.webServerASG.CapacityRebalance = launchTemplateConfig.get('capacityRebalance', True)
+        else:
+            self.webServerASG.LaunchConfigurationName = Ref(self.asgLaunchConfig)
+
+        if self.observability is not None:
+            # Group size metrics for the dashboard
+            self.webServerASG.MetricsCollection = [MetricsCollection(Granularity='1Minute')]
+
+        if self.efsMountTargets:
+            self.webServerASG.DependsOn = [mountTarget.title for mountTarget in self.efsMountTargets]
+
+        if self.loadBalancerType == 'application':
+            self.webServerASG.TargetGroupARNs = [Ref(self.elbTargetGroup)]
+        else:
+            self.webServerASG.LoadBalancerNames = [Ref(self.elb)]
+
+        return 0
+
+    def build_mixed_instances_policy(self, launchTemplateConfig):
+        # The profile's instance type comes first so it is preferred for
+        # on demand capacity, the other types widen the spot pools.
+        instanceTypes = [self.capacity['webInstanceType']]
+        for instanceType in launchTemplateConfig.get('instanceTypes', []):
+            if instanceType not in instanceTypes:
+                instanceTypes.append(instanceType)
+
+        onDemandPercentage = launchTemplateConfig.get('onDemandPercentageAboveBaseCapacity', 100)
+        if not 0 <= onDemandPercentage <= 100:
+            raise ValueError("onDemandPercentageAboveBaseCapacity is {} but must be between 0 and 100".format(
+                onDemandPercentage))
+
+        distribution = InstancesDistribution(
+            OnDemandAllocationStrategy='prioritized',
+            OnDemandBaseCapacity=launchTemplateConfig.get('onDemandBaseCapacity', 0),
+            OnDemandPercentageAboveBaseCapacity=onDemandPercentage,
+            SpotAllocationStrategy=launchTemplateConfig.get('spotAllocationStrategy', 'capacity-optimized')
+        )
+        if 'spotMaxPrice' in launchTemplateConfig:
+            distribution.SpotMaxPrice = str(launchTemplateConfig['spotMaxPrice'])
+
+        return MixedInstancesPolicy(
+            LaunchTemplate=ASGLaunchTemplate(
+                LaunchTemplateSpecification=LaunchTemplateSpecification(
+                    LaunchTemplateId=Ref(self.launchTemplate),
+                    Version=GetAtt(self.launchTemplate, 'LatestVersionNumber')
+                ),
+                Overrides=[LaunchTemplateOverrides(InstanceType=instanceType) for instanceType in instanceTypes]
+            ),
+            InstancesDistribution=distribution
+        )
+
+    def build_update_policy(self):
+        # Instances are replaced maxBatchSize at a time, each batch waiting
+        # up to pauseTime for its instances to signal that cfn-init worked.
+        rollingConfig = self.sceptreUserData.get('rollingUpdate', {})
+        minInService = rollingConfig.get('minInstancesInService', 1)
+        if minInService >= self.capacity['asgMaxSize']:
+            raise ValueError("minInstancesInService is {} but must be less than the asgMaxSize of {}".format(
+                minInService, self.capacity['asgMaxSize']))
+
+        rollingUpdate = AutoScalingRollingUpdate(
+            MaxBatchSize=str(rollingConfig.get('maxBatchSize', 1)),
+            MinInstancesInService=str(minInService),
+            PauseTime=rollingConfig.get('pauseTime', 'PT15M'),
+            WaitOnResourceSignals=rollingConfig.get('waitOnResourceSignals', True)
+        )
+        if rollingConfig.get('suspendProcesses'):
+            # Stops scaling and health checks from fighting the update
+            rollingUpdate.SuspendProcesses = rollingConfig['suspendProcesses']
+        updatePolicy = UpdatePolicy(AutoScalingRollingUpdate=rollingUpdate)
+        if self.sceptreUserData.get('schedule'):
+            # Stack updates keep the sizes set by the scheduled actions
+            updatePolicy.AutoScalingScheduledAction = AutoScalingScheduledAction(
+                IgnoreUnmodifiedGroupSizeProperties=True
+            )
+        return updatePolicy
+
+    def build_creation_policy(self):
+        # The stack waits for every initial instance to signal
+        rollingConfig = self.sceptreUserData.get('rollingUpdate', {})
+        creationPolicy = CreationPolicy(
+            ResourceSignal=ResourceSignal(
+                Count=rollingConfig.get('signalCount', self.capacity['asgDesiredCapacity']),
+                Timeout=rollingConfig.get('signalTimeout', 'PT30M')
+            )
+        )
+        if 'minSuccessfulInstancesPercent' in rollingConfig:
+            creationPolicy.AutoScalingCreationPolicy = AutoScalingCreationPolicy(
+                MinSuccessfulInstancesPercent=rollingConfig['minSuccessfulInstancesPercent']
+            )
+        return creationPolicy
+
+    def scaling_metric_dimensions(self, metric):
+        # Returns the (name, value) pairs a scaling metric is dimensioned on.
+        scalingMetrics = SCALING_METRICS[self.loadBalancerType]
+        if metric not in scalingMetrics:
+            raise ValueError("Unknown scaling metric '{}', must be one of {}".format(
+                metric, ', '.join(sorted(scalingMetrics))))
+        target = scalingMetrics[metric][3]
+        if target == 'targetGroup':
+            return [('TargetGroup', GetAtt(self.elbTargetGroup, 'TargetGroupFullName'))]
+        if target == 'elb' and self.loadBalancerType == 'application':
+            return [('LoadBalancer', GetAtt(self.elb, 'LoadBalancerFullName'))]
+        if target == 'elb':
+            return [('LoadBalancerName', Ref(self.elb))]
+        return [('AutoScalingGroupName', Ref(self.webServerASG))]
+
+    def add_scaling_policies(self):
+        t = self.template
+        scaling = self.sceptreUserData.get('scaling', {})
+        scalingMetrics = SCALING_METRICS[self.loadBalancerType]
+
+        # Target tracking policies keep a metric at the given value,
+        # letting AWS create and manage the alarms itself.
+        for policy in scaling.get('targetTracking', []):
+            metric = policy['metric']
+            dimensions = self.scaling_metric_dimensions(metric)
+            namespace, metricName, statistic = scalingMetrics[metric][:3]
+
+            if metric == 'cpu':
+                trackingConfig = TargetTrackingConfiguration(
+                    PredefinedMetricSpecification=PredefinedMetricSpecification(
+                        PredefinedMetricType='ASGAverageCPUUtilization'
+                    ),
+                    TargetValue=float(policy['targetValue']),
+                    DisableScaleIn=policy.get('disableScaleIn', False)
+                )
+            elif metric == 'requestCount' and self.loadBalancerType == 'application':
+                trackingConfig = TargetTrackingConfiguration(
+                    PredefinedMetricSpecification=PredefinedMetricSpecification(
+                        PredefinedMetricType='ALBRequestCountPerTarget',
+                        ResourceLabel=Join('/', [
+                            GetAtt(self.elb, 'LoadBalancerFullName'),
+                            GetAtt(self.elbTargetGroup, 'TargetGroupFullName')
+                        ])
+                    ),
+                    TargetValue=float(policy['targetValue']),
+                    DisableScaleIn=policy.get('disableScaleIn', False)
+                )
+            elif metric == 'requestCount':
+                # A classic ELB only reports the total request count, which
+                # does not fall as instances are added.
+                raise ValueError("Target tracking on requestCount needs an application load balancer.")
+            else:
+                trackingConfig = TargetTrackingConfiguration(
+                    CustomizedMetricSpecification=CustomizedMetricSpecification(
+                        Namespace=namespace,
+                        MetricName=metricName,
+                        Statistic=statistic,
+                        Dimensions=[MetricDimension(Name=n, Value=v) for n, v in dimensions]
+                    ),
+                    TargetValue=float(policy['targetValue']),
+                    DisableScaleIn=policy.get('disableScaleIn', False)
+                )
+
+            t.add_resource(ScalingPolicy(
+                policy['name']+'ScalingPolicy',
+                AutoScalingGroupName=Ref(self.webServerASG),
+                PolicyType='TargetTrackingScaling',
+                EstimatedInstanceWarmup=policy.get('warmup', 600),
+                TargetTrackingConfiguration=trackingConfig
+            ))
+
+        # Step policies are triggered by an alarm on the metric and change
+        # the capacity by an amount depending on how far it is breached.
+        for policy in scaling.get('stepScaling', []):
+            metric = policy['metric']
+            dimensions = self.scaling_metric_dimensions(metric)
+            namespace, metricName, statistic = scalingMetrics[metric][:3]
+            statistic = policy.get('statistic', statistic)
+
+            stepPolicy = t.add_resource(ScalingPolicy(
+                policy['name']+'ScalingPolicy',
+                AutoScalingGroupName=Ref(self.webServerASG),
+                PolicyType='StepScaling',
+                AdjustmentType=policy.get('adjustmentType', 'ChangeInCapacity'),
+                # Sum is not a valid aggregation type for step policies.
+                MetricAggregationType='Average' if statistic == 'Sum' else statistic,
+                EstimatedInstanceWarmup=policy.get('warmup', 600),
+                StepAdjustments=[
+                    self.build_step_adjustment(step) for step in policy['steps']
+                ]
+            ))
+
+            t.add_resource(Alarm(
+                policy['name']+'Alarm',
+                AlarmDescription='Triggers the {} scaling policy.'.format(policy['name']),
+                Namespace=namespace,
+                MetricName=metricName,
+                Statistic=statistic,
+                Dimensions=[AlarmDimension(Name=n, Value=v) for n, v in dimensions],
+                Period=policy.get('period', 60),
+                EvaluationPeriods=policy.get('evaluationPeriods', 2),
+                Threshold=policy['threshold'],
+                ComparisonOperator=policy.get('comparison', 'GreaterThanOrEqualToThreshold'),
+                AlarmActions=[Ref(stepPolicy)]
+            ))
+
+        return 0
+
+    def add_scheduled_actions(self):
+        t = self.template
+
+        # Sets the group size ahead of known traffic, as a new instance
+        # takes minutes to boot. Recurrences are cron expressions in UTC.
+        for action in self.sceptreUserData.get('schedule') or []:
+            sizes = dict((key, action[key]) for key in ['minSize', 'maxSize', 'desiredCapacity'] if key in action)
+            if not sizes:
+                raise ValueError("Scheduled action {} must set minSize, maxSize or desiredCapacity".format(action['name']))
+            if 'recurrence' not in action and 'startTime' not in action:
+                raise ValueError("Scheduled action {} needs a recurrence or a startTime".format(action['name']))
+            if 'recurrence' in action and len(action['recurrence'].split()) != 5:
+                raise ValueError("Scheduled action {} recurrence '{}' must be a five field cron expression".format(
+                    action['name'], action['recurrence']))
+            # Sizes left out keep the group's, which is at most asgMaxSize
+            maxSize = sizes.get('maxSize', self.capacity['asgMaxSize'])
+            if max(sizes.get('minSize', 0), sizes.get('desiredCapacity', 0)) > maxSize:
+                raise ValueError("Scheduled action {} sizes the group above its maxSize of {}".format(
+                    action['name'], maxSize))
+            if sizes.get('desiredCapacity', sizes.get('minSize', 0)) < sizes.get('minSize', 0):
+                raise ValueError("Scheduled action {} desiredCapacity is below its minSize".format(action['name']))
+
+            scheduledAction = t.add_resource(ScheduledAction(
+                action['name']+'ScheduledAction',
+                AutoScalingGroupName=Ref(self.webServerASG)
+            ))
+            if 'recurrence' in action:
+                scheduledAction.Recurrence = action['recurrence']
+            for key, prop in [('minSize', 'MinSize'), ('maxSize', 'MaxSize'), ('desiredCapacity', 'DesiredCapacity')]:
+                if key in sizes:
+                    setattr(scheduledAction, prop, sizes[key])
+            for key, prop in [('startTime', 'StartTime'), ('endTime', 'EndTime')]:
+                if key in action:
+                    setattr(scheduledAction, prop, self.schedule_time(action[key]))
+
+        return 0
+
+    def schedule_time(self, value):
+        # YAML reads unquoted timestamps as datetimes
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+        if isinstance(value, datetime.date):
+            return value.strftime('%Y-%m-%dT00:00:00Z')
+        datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+        return value
+
+    def build_step_adjustment(self, step):
+        # Bounds are relative to the alarm threshold, a missing bound is infinite.
+        stepAdjustment = StepAdjustments(ScalingAdjustment=step['adjustment'])
+        if 'lower' in step:
+            stepAdjustment.MetricIntervalLowerBound = step['lower']
+        if 'upper' in step:
+            stepAdjustment.MetricIntervalUpperBound = step['upper']
+        return stepAdjustment
+
+    def add_cdn(self):
+        t = self.template
+        self.cdn = None
+        cdnConfig = self.sceptreUserData.get('cdn')
+        if cdnConfig is None:
+            return 0
+
+        staticTtl = cdnConfig.get('staticTtl', 604800)
+        dynamicTtl = cdnConfig.get('dynamicTtl', 60)
+        allMethods = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'PATCH', 'POST', 'DELETE']
+
+        # Theme, plugin, upload and core assets are versioned by query
+        # string so can be cached for a long time with no cookies.
+        staticBehaviors = [
+            CacheBehavior(
+                PathPattern=pathPattern,
+                TargetOriginId='Elb',
+                ViewerProtocolPolicy='redirect-to-https',
+                AllowedMethods=['GET', 'HEAD'],
+                Compress=True,
+                MinTTL=0,
+                DefaultTTL=staticTtl,
+                MaxTTL=staticTtl * 4,
+                ForwardedValues=ForwardedValues(
+                    QueryString=True,
+                    Cookies=Cookies(Forward='none')
+                )
+            )
+            for pathPattern in ['/wp-content/*', '/wp-includes/*']
+        ]
+
+        # The admin pages and login are never cached.
+        adminBehaviors = [
+            CacheBehavior(
+                PathPattern=pathPattern,
+                TargetOriginId='Elb',
+                ViewerProtocolPolicy='redirect-to-https',
+                AllowedMethods=allMethods,
+                Compress=True,
+                MinTTL=0,
+                DefaultTTL=0,
+                MaxTTL=0,
+                ForwardedValues=ForwardedValues(
+                    QueryString=True,
+                    Headers=['*'],
+                    Cookies=Cookies(Forward='all')
+                )
+            )
+            for pathPattern in ['/wp-admin/*', '/wp-login.php']
+        ]
+
+        origins = [
+            Origin(
+                Id='Elb',
+                DomainName=GetAtt(self.elb, 'DNSName'),
+                CustomOriginConfig=CustomOriginConfig(
+                    HTTPPort=80,
+                    OriginProtocolPolicy='http-only'
+                )
+            )
+        ]
+
+        # Offloaded media is fetched straight from the bucket, which only
+        # CloudFront is allowed to read.
+        mediaBehaviors = []
+        if self.mediaBucket:
+            self.mediaOai = t.add_resource(CloudFrontOriginAccessIdentity(
+                'MediaOriginAccessIdentity',
+                CloudFrontOriginAccessIdentityConfig=CloudFrontOriginAccessIdentityConfig(
+                    Comment=Join("", [self.namePrefix, 'MediaOriginAccessIdentity'])
+                )
+            ))
+            t.add_resource(BucketPolicy(
+                'MediaBucketPolicy',
+                Bucket=Ref(self.mediaBucket),
+                PolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [{
+                        "Effect": "Allow",
+                        "Principal": { "CanonicalUser": GetAtt(self.mediaOai, 'S3CanonicalUserId') },
+                        "Action": ["s3:GetObject"],
+                        "Resource": [Join("", [GetAtt(self.mediaBucket, 'Arn'), "/*"])]
+                    }]
+                }
+            ))
+            origins.append(Origin(
+                Id='MediaBucket',
+                DomainName=GetAtt(self.mediaBucket, 'RegionalDomainName'),
+                S3OriginConfig=S3OriginConfig(
+                    OriginAccessIdentity=Join("", ['origin-access-identity/cloudfront/', Ref(self.mediaOai)])
+                )
+            ))
+            mediaBehaviors.append(CacheBehavior(
+                PathPattern='/wp-content/uploads/*',
+                TargetOriginId='MediaBucket',
+                ViewerProtocolPolicy='redirect-to-https',
+                AllowedMethods=['GET', 'HEAD'],
+                Compress=True,
+                MinTTL=0,
+                DefaultTTL=staticTtl,
+                MaxTTL=staticTtl * 4,
+                ForwardedValues=ForwardedValues(
+                    QueryString=False,
+                    Cookies=Cookies(Forward='none')
+                )
+            ))
+
+        self.cdn = t.add_resource(Distribution(
+            'CloudFrontDistribution',
+            DistributionConfig=DistributionConfig(
+                Comment=Join("", [self.namePrefix, 'CloudFrontDistribution']),
+                Enabled=True,
+                HttpVersion='http2',
+                PriceClass=cdnConfig.get('priceClass', 'PriceClass_100'),
+                Origins=origins,
+                # Everything else is dynamic, cached briefly per query string
+                # and WordPress cookie.
+                DefaultCacheBehavior=DefaultCacheBehavior(
+                    TargetOriginId='Elb',
+                    ViewerProtocolPolicy='redirect-to-https',
+                    AllowedMethods=allMethods,
+                    Compress=True,
+                    MinTTL=0,
+                    DefaultTTL=dynamicTtl,
+                    MaxTTL=dynamicTtl,
+                    ForwardedValues=ForwardedValues(
+                        QueryString=True,
+                        Cookies=Cookies(
+                            Forward='whitelist',
+                            WhitelistedNames=WORDPRESS_COOKIES
+                        )
+                    )
+                ),
+                CacheBehaviors=mediaBehaviors + staticBehaviors + adminBehaviors
+            )
+        ))
+        return 0
+
+    def json_join(self, value):
+        # Serializes value to a JSON string which can hold Refs and
+        # GetAtts, by swapping them for tokens and splitting on those.
+        functions = []
+        def swap(item):
+            if isinstance(item, dict):
+                return dict((key, swap(child)) for key, child in item.items())
+            if isinstance(item, list):
+                return [swap(child) for child in item]
+            if isinstance(item, (Ref, GetAtt, Join)):
+                functions.append(item)
+                return '@@{}@@'.format(len(functions) - 1)
+            return item
+        parts = re.split(r'@@(\d+)@@', json.dumps(swap(value), sort_keys=True))
+        # Every other part is the index of a function
+        return Join("", [functions[int(part)] if i % 2 else part for i, part in enumerate(parts) if part])
+
+    def dashboard_widgets(self):
+        # (title, stat, metrics) for each graph, metrics being
+        # [namespace, name, dimension, value, ...] lists.
+        widgets = []
+        asgDimension = ['AutoScalingGroupName', Ref(self.webServerASG)]
+        if self.loadBalancerType == 'application':
+            lbDimension = ['LoadBalancer', GetAtt(self.elb, 'LoadBalancerFullName')]
+            tgDimension = ['TargetGroup', GetAtt(self.elbTargetGroup, 'TargetGroupFullName')] + lbDimension
+            widgets += [
+                ('Response time', 'p95', [['AWS/ApplicationELB', 'TargetResponseTime'] + lbDimension]),
+                ('Requests and 5xx', 'Sum', [
+                    ['AWS/ApplicationELB', 'RequestCount'] + lbDimension,
+                    ['AWS/ApplicationELB', 'HTTPCode_Target_5XX_Count'] + lbDimension,
+                    ['AWS/ApplicationELB', 'HTTPCode_ELB_5XX_Count'] + lbDimension
+                ]),
+                ('Target health', 'Minimum', [
+                    ['AWS/ApplicationELB', 'HealthyHostCount'] + tgDimension,
+                    ['AWS/ApplicationELB', 'UnHealthyHostCount'] + tgDimension
+                ])
+            ]
+        else:
+            lbDimension = ['LoadBalancerName', Ref(self.elb)]
+            widgets += [
+                ('Latency', 'p95', [['AWS/ELB', 'Latency'] + lbDimension]),
+                ('Requests and 5xx', 'Sum', [
+                    ['AWS/ELB', 'RequestCount'] + lbDimension,
+                    ['AWS/ELB', 'HTTPCode_Backend_5XX'] + lbDimension,
+                    ['AWS/ELB', 'HTTPCode_ELB_5XX'] + lbDimension
+                ]),
+                ('Surge queue and spillover', 'Maximum', [
+                    ['AWS/ELB', 'SurgeQueueLength'] + lbDimension,
+                    ['AWS/ELB', 'SpilloverCount'] + lbDimension
+                ]),
+                ('Instance health', 'Minimum', [
+                    ['AWS/ELB', 'HealthyHostCount'] + lbDimension,
+                    ['AWS/ELB', 'UnHealthyHostCount'] + lbDimension
+                ])
+            ]
+
+        widgets += [
+            ('Web servers', 'Average', [
+                ['AWS/AutoScaling', 'GroupDesiredCapacity'] + asgDimension,
+                ['AWS/AutoScaling', 'GroupInServiceInstances'] + asgDimension
+            ]),
+            ('Web server CPU and memory', 'Average', [
+                ['AWS/EC2', 'CPUUtilization'] + asgDimension,
+                ['CWAgent', 'mem_used_percent'] + asgDimension
+            ])
+        ]
+
+        if self.rdsCluster:
+            widgets += self.aurora_dashboard_widgets()
+        else:
+            widgets += self.database_dashboard_widgets()
+
+        if self.cache:
+            cacheDimension = ['CacheClusterId', Ref(self.cache)]
+            widgets.append(('Object cache', 'Average', [
+                ['AWS/ElastiCache', 'CPUUtilization'] + cacheDimension,
+                ['AWS/ElastiCache', 'CurrConnections'] + cacheDimension,
+                ['AWS/ElastiCache', 'Evictions'] + cacheDimension
+            ]))
+        if self.efs:
+            efsDimension = ['FileSystemId', Ref(self.efs)]
+            widgets.append(('Shared content', 'Average', [
+                ['AWS/EFS', 'PercentIOLimit'] + efsDimension,
+                ['AWS/EFS', 'ClientConnections'] + efsDimension
+            ]))
+        return widgets
+
+    def database_dashboard_widgets(self):
+        databases = [self.rds] + self.rdsReplicas
+        databaseMetrics = [['AWS/RDS', 'CPUUtilization', 'DBInstanceIdentifier', Ref(db)] for db in databases]
+        databaseMetrics += [['AWS/RDS', 'DBLoad', 'DBInstanceIdentifier', Ref(db)]
+                            for db in self.performanceInsightsInstances]
+        return [
+            ('Database CPU and load', 'Average', databaseMetrics),
+            ('Database connections', 'Maximum',
+                [['AWS/RDS', 'DatabaseConnections', 'DBInstanceIdentifier', Ref(db)] for db in databases]),
+            ('Database latency', 'Average', [
+                ['AWS/RDS', 'ReadLatency', 'DBInstanceIdentifier', Ref(self.rds)],
+                ['AWS/RDS', 'WriteLatency', 'DBInstanceIdentifier', Ref(self.rds)]
+            ] + [['AWS/RDS', 'ReplicaLag', 'DBInstanceIdentifier', Ref(db)] for db in self.rdsReplicas])
+        ]
+
+    def aurora_dashboard_widgets(self):
+        # Readers added by auto scaling aren't in the template, so the
+        # cluster metrics are graphed by role.
+        writer = ['DBClusterIdentifier', Ref(self.rdsCluster), 'Role', 'WRITER']
+        reader = ['DBClusterIdentifier', Ref(self.rdsCluster), 'Role', 'READER']
+        cluster = ['DBClusterIdentifier', Ref(self.rdsCluster)]
+        return [
+            ('Database CPU', 'Average', [
+                ['AWS/RDS', 'CPUUtilization'] + writer,
+                ['AWS/RDS', 'CPUUtilization'] + reader
+            ] + [['AWS/RDS', 'DBLoad', 'DBInstanceIdentifier', Ref(db)]
+                 for db in self.performanceInsightsInstances]),
+            ('Database connections', 'Maximum', [
+                ['AWS/RDS', 'DatabaseConnections'] + writer,
+                ['AWS/RDS', 'DatabaseConnections'] + reader
+            ]),
+            ('Database latency', 'Average', [
+                ['AWS/RDS', 'SelectLatency'] + reader,
+                ['AWS/RDS', 'CommitLatency'] + writer,
+                ['AWS/RDS', 'AuroraReplicaLagMaximum'] + cluster
+            ])
+        ]
+
+    def add_dashboard(self):
+        t = self.template
+        self.dashboard = None
+        if self.observability is None or not self.observability.get('dashboard', True):
+            return 0
+
+        widgets = []
+        for i, (title, stat, metrics) in enumerate(self.dashboard_widgets()):
+            widgets.append({
+                "type": "metric",
+                "x": (i % 2) * 12,
+                "y": (i // 2) * 6,
+                "width": 12,
+                "height": 6,
+                "properties": {
+                    "title": title,
+                    "region": Ref("AWS::Region"),
+                    "stat": stat,
+                    "period": 60,
+                    "metrics": metrics
+                }
+            })
+        if self.cdn:
+            # CloudFront metrics only exist in us-east-1
+            cdnDimension = ['DistributionId', Ref(self.cdn), 'Region', 'Global']
+            widgets.append({
+                "type": "metric",
+                "x": (len(widgets) % 2) * 12,
+                "y": (len(widgets) // 2) * 6,
+                "width": 12,
+                "height": 6,
+                "properties": {
+                    "title": "CloudFront",
+                    "region": "us-east-1",
+                    "stat": "Average",
+                    "period": 60,
+                    "metrics": [
+                        ['AWS/CloudFront', 'Requests'] + cdnDimension + [{"stat": "Sum"}],
+                        ['AWS/CloudFront', '5xxErrorRate'] + cdnDimension
+                    ]
+                }
+            })
+
+        self.dashboard = t.add_resource(Dashboard(
+            'Dashboard',
+            DashboardName=Join("-", [Ref("AWS::StackName"), 'wordpress']),
+            DashboardBody=self.json_join({"widgets": widgets})
+        ))
         return 0
 
     def add_outputs(self):
         t = self.template
 
+        # The application load balancer always has the certificate and
+        # serves HTTPS.
+        scheme = 'https://' if self.loadBalancerType == 'application' else 'http://'
         self.websiteUrl = t.add_output(Output(
             'websiteUrl',
-            Value=Join('', ['http://', GetAtt(self.elb, 'DNSName')]),
+            Value=Join('', [scheme, GetAtt(self.elb, 'DNSName')]),
             Description='Wordpress website URL.'
         ))
 
+        if self.rdsCluster:
+            t.add_output(Output(
+                'readerEndpoint',
+                Value=GetAtt(self.rdsCluster, 'ReadEndpoint.Address'),
+                Description='Aurora reader endpoint, balanced over every reader.'
+            ))
+
+        for i, replica in enumerate(self.rdsReplicas):
+            t.add_output(Output(
+                'readReplica{}Endpoint'.format(i+1),
+                Value=GetAtt(replica, 'Endpoint.Address'),
+                Description='Database read replica endpoint.'
+            ))
+
+        if self.mediaBucket:
+            self.mediaBucketOutput = t.add_output(Output(
+                'mediaBucket',
+                Value=Ref(self.mediaBucket),
+                Description='S3 bucket WordPress media is offloaded to.'
+            ))
+
+        if self.cdn:
+            self.edgeUrl = t.add_output(Output(
+                'edgeUrl',
+                Value=Join('', ['https://', GetAtt(self.cdn, 'DomainName')]),
+                Description='Wordpress website URL through CloudFront.'
+            ))
+
+        if self.cache:
+            self.cacheEndpointOutput = t.add_output(Output(
+                'cacheEndpoint',
+                Value=Join(':', [
+                    GetAtt(self.cache, self.cacheEndpoint+'.Address'),
+                    GetAtt(self.cache, self.cacheEndpoint+'.Port')
+                ]),
+                Description='ElastiCache object cache endpoint.'
+            ))
+
+        if self.dashboard:
+            self.dashboardUrl = t.add_output(Output(
+                'dashboardUrl',
+                Value=Join('', [
+                    'https://console.aws.amazon.com/cloudwatch/home?region=', Ref('AWS::Region'),
+                    '#dashboards:name=', Ref(self.dashboard)
+                ]),
+                Description='CloudWatch dashboard for the stack.'
+            ))
+
         return 0
 
 
-def sceptre_handler(sceptre_user_data):
+def render(sceptre_user_data):
     server = Wordpress(sceptre_user_data)
-    return server.template.to_json()
+    return template_output.serialize(server.template, sceptre_user_data)
+
+def sceptre_handler(sceptre_user_data):
+    return render_cache.cached_render(
+        __file__, sceptre_user_data,
+        lambda: render_client.render(__file__, sceptre_user_data, render),
+        dependencies=[capacity.PROFILES_PATH])
 
 if __name__ == '__main__':
     # for debugging
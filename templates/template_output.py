@@ -0,0 +1,101 @@
+# Serializes the templates for sceptre_handler. By default the JSON is
+# pretty printed as before, the templateOutput block of
+# sceptre_user_data can shrink it to stay under CloudFormation's body
+# size limits:
+#
+#   templateOutput:
+#     compact: true     # no indentation or spaces between tokens
+#     dedupJoins: true  # merge and share repeated Fn::Join fragments
+
+import json
+
+FRAGMENTS_MAPPING = 'TemplateFragments'
+FRAGMENTS_KEY = 'Join'
+# Shorter fragments cost more as a Fn::FindInMap than they save
+MIN_FRAGMENT_LENGTH = 40
+
+
+def serialize(template, sceptre_user_data):
+    options = sceptre_user_data.get('templateOutput', {})
+    if not options.get('compact') and not options.get('dedupJoins'):
+        return template.to_json()
+
+    body = template.to_dict()
+    if options.get('dedupJoins'):
+        body = dedup_joins(body, options.get('minFragmentLength', MIN_FRAGMENT_LENGTH))
+    if options.get('compact'):
+        return json.dumps(body, sort_keys=True, separators=(',', ':'))
+    return json.dumps(body, indent=4, sort_keys=True, separators=(',', ': '))
+
+
+def is_join(value):
+    return isinstance(value, dict) and list(value) == ['Fn::Join']
+
+
+def merge_literals(delimiter, parts):
+    # Neighbouring strings in a join can be joined up front
+    merged = []
+    for part in parts:
+        if isinstance(part, str) and merged and isinstance(merged[-1], str):
+            merged[-1] = merged[-1] + delimiter + part
+        else:
+            merged.append(part)
+    return merged
+
+
+def walk(value, visit):
+    # Rebuilds value bottom up, passing every dict and list to visit
+    if isinstance(value, dict):
+        return visit(dict((key, walk(item, visit)) for key, item in value.items()))
+    if isinstance(value, list):
+        return visit([walk(item, visit) for item in value])
+    return value
+
+
+def dedup_joins(body, minFragmentLength=MIN_FRAGMENT_LENGTH):
+    """Merges the neighbouring string parts of every Fn::Join and moves
+    string parts used more than once into a mapping, replacing them with
+    Fn::FindInMap. Joins left with a single string become that string."""
+    def merge(value):
+        if is_join(value):
+            delimiter, parts = value['Fn::Join']
+            if isinstance(parts, list):
+                return {'Fn::Join': [delimiter, merge_literals(delimiter, parts)]}
+        return value
+    body = walk(body, merge)
+
+    counts = {}
+    def count(value):
+        if is_join(value) and isinstance(value['Fn::Join'][1], list):
+            for part in value['Fn::Join'][1]:
+                if isinstance(part, str) and len(part) >= minFragmentLength:
+                    counts[part] = counts.get(part, 0) + 1
+        return value
+    walk(body, count)
+
+    fragments = {}
+    for fragment in sorted(counts, key=lambda fragment: (-counts[fragment], fragment)):
+        if counts[fragment] > 1:
+            fragments[fragment] = 'F{}'.format(len(fragments) + 1)
+
+    def share(value):
+        if is_join(value) and isinstance(value['Fn::Join'][1], list):
+            delimiter, parts = value['Fn::Join']
+            if len(parts) == 1 and isinstance(parts[0], str) and parts[0] not in fragments:
+                return parts[0]
+            return {'Fn::Join': [delimiter, [
+                {'Fn::FindInMap': [FRAGMENTS_MAPPING, FRAGMENTS_KEY, fragments[part]]}
+                if isinstance(part, str) and part in fragments else part
+                for part in parts
+            ]]}
+        return value
+    body = walk(body, share)
+
+    if fragments:
+        mappings = body.setdefault('Mappings', {})
+        if FRAGMENTS_MAPPING in mappings:
+            raise ValueError("The template already has a {} mapping".format(FRAGMENTS_MAPPING))
+        mappings[FRAGMENTS_MAPPING] = {
+            FRAGMENTS_KEY: dict((name, fragment) for fragment, name in fragments.items())
+        }
+    return body
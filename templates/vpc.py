@@ -2,9 +2,15 @@
 # This template generates a VPC following the config from the vpc.yaml file.
 # Template is modified for Sceptre (http://sceptre.ce-tools.cloudreach.com).
 
+import ipaddress
+import itertools
+
 from troposphere import Output, Parameter, Ref, Template, Join
-from troposphere import GetAZs, Select, Join, GetAtt
+from troposphere import GetAZs, Select, GetAtt
 import troposphere.ec2 as ec2
+import render_cache
+import render_client
+import template_output
 
 class Vpc(object):
     def __init__(self, sceptre_user_data):
@@ -13,6 +19,11 @@ class Vpc(object):
         self.sceptreUserData = sceptre_user_data
         self.environment = self.sceptreUserData['environment']
         self.numAz = self.sceptreUserData['numAz']
+        # single puts one NAT gateway in the first AZ, perAz puts one in
+        # every AZ so NAT traffic never crosses AZs.
+        self.natMode = self.sceptreUserData.get('natMode', 'single')
+        if self.natMode not in ['single', 'perAz']:
+            raise ValueError("Unknown natMode '{}', must be single or perAz".format(self.natMode))
 
         self.add_parameters()
 
@@ -34,6 +45,7 @@ class Vpc(object):
         self.add_route_tables()
         self.add_routes()
         self.associate_route_tables()
+        self.add_gateway_endpoints()
 
         self.add_outputs()
 
@@ -96,13 +108,51 @@ class Vpc(object):
     def add_subnets(self):
         t = self.template
 
+        # Each tier lists the base address of its subnet in every AZ. New
+        # VPCs can set subnetPrefixLength and carveCidr instead, which
+        # carves the AZs a tier doesn't list out of carveCidr. Each tier
+        # gets a block of azSlots subnets so adding AZs never moves an
+        # existing subnet. carveCidr must be inside vpcCidr and clear of the
+        # listed subnets, an overlap is refused here.
+        listed = []
         for subnetDict in self.subnets:
+            for key in sorted(subnetDict):
+                if key.startswith('az') and key[2:].isdigit():
+                    listed.append((subnetDict['tier']+'Az'+key[2:]+'Subnet',
+                        ipaddress.ip_network(subnetDict[key] + subnetDict['suffix'])))
+
+        prefixLength = self.sceptreUserData.get('subnetPrefixLength')
+        cidrs = None
+        if prefixLength:
+            if 'carveCidr' not in self.sceptreUserData:
+                raise ValueError("subnetPrefixLength needs carveCidr, the block the subnets are carved from")
+            azSlots = self.sceptreUserData.get('azSlots', 6)
+            if self.numAz > azSlots:
+                raise ValueError("numAz is {} but each tier only has {} azSlots".format(self.numAz, azSlots))
+            carveCidr = ipaddress.ip_network(self.sceptreUserData['carveCidr'])
+            numCidrs = len(self.subnets) * azSlots
+            if prefixLength < carveCidr.prefixlen or 2 ** (prefixLength - carveCidr.prefixlen) < numCidrs:
+                raise ValueError("{} subnets of /{} needed but carveCidr {} is too small".format(
+                    numCidrs, prefixLength, carveCidr))
+            cidrs = list(itertools.islice(carveCidr.subnets(new_prefix=prefixLength), numCidrs))
+
+        for tierNum, subnetDict in enumerate(self.subnets):
             for i in range(0, self.numAz):
                 az = Select(i, GetAZs())
                 azNum=str(i+1)
                 subnetName = subnetDict['tier']+'Az'+azNum+'Subnet'
-                baseCidr = subnetDict['az'+azNum]
-                cidr = baseCidr + subnetDict['suffix']
+                if 'az'+azNum in subnetDict:
+                    cidr = subnetDict['az'+azNum] + subnetDict['suffix']
+                elif cidrs is not None:
+                    carved = cidrs[tierNum * azSlots + i]
+                    for listedName, listedCidr in listed:
+                        if carved.overlaps(listedCidr):
+                            raise ValueError("{} would be carved as {} which overlaps {} at {}".format(
+                                subnetName, carved, listedName, listedCidr))
+                    cidr = str(carved)
+                else:
+                    raise ValueError("Tier {} has no az{} address, list it or set subnetPrefixLength".format(
+                        subnetDict['tier'], azNum))
                 subnet = self.build_subnet(t, subnetName, az, cidr)
                 subnetDict['ID'+azNum] = Ref(subnet)
 
@@ -123,41 +173,65 @@ class Vpc(object):
 
     def add_natgw(self):
         t = self.template
-        natGwSubnetId = None
+        natGwSubnet = None
 
         for subnetDict in self.subnets:
             if subnetDict['useIgw']:
-                natGwSubnetId=subnetDict['ID1']
-            if natGwSubnetId != None:
+                natGwSubnet = subnetDict
+            if natGwSubnet != None:
                 break
 
-        self.natEip = t.add_resource(ec2.EIP(
-            'NatEIP',
+        # The first AZ's NAT gateway keeps the single mode names so
+        # switching to perAz only adds gateways, the existing one and its
+        # Elastic IP stay.
+        self.natGws = {}
+        self.natGws['1'] = self.build_natgw(t, '', natGwSubnet['ID1'])
+        if self.natMode == 'single':
+            return
+
+        for i in range(1, self.numAz):
+            azNum = str(i+1)
+            self.natGws[azNum] = self.build_natgw(t, 'AZ'+azNum, natGwSubnet['ID'+azNum])
+
+    def build_natgw(self, t, suffix, subnetId):
+        natEip = t.add_resource(ec2.EIP(
+            'NatEIP'+suffix,
             Domain='vpc'
         ))
 
-        self.natGw = t.add_resource(ec2.NatGateway(
-            'NatGateway',
-            AllocationId=GetAtt(self.natEip, "AllocationId"),
-            SubnetId=natGwSubnetId
+        natGw = t.add_resource(ec2.NatGateway(
+            'NatGateway'+suffix,
+            AllocationId=GetAtt(natEip, "AllocationId"),
+            SubnetId=subnetId
         ))
+        return natGw
+
+    def route_table_name(self, subnetDict, azNum):
+        # NAT tiers get a route table per AZ when there is a NAT gateway per
+        # AZ, the first AZ keeps the tier's route table.
+        if subnetDict['useNat'] and self.natMode == 'perAz' and azNum != '1':
+            return subnetDict['tier']+'AZ'+azNum+'RouteTable'
+        return subnetDict['tier']+'RouteTable'
 
     def add_route_tables(self):
         t = self.template
 
         for subnetDict in self.subnets:
-            tableName = subnetDict['tier']+'RouteTable'
-            routeTable = t.add_resource(ec2.RouteTable(
-                tableName,
-                VpcId=Ref(self.vpc),
-                Tags=self.defaultTags + [
-                ec2.Tag('Name', Join("", [
-                    self.namePrefix,
-                    tableName
-                ]))
-            ]
-            ))
-            self.routeTables[tableName] = Ref(routeTable)
+            for i in range(0, self.numAz):
+                tableName = self.route_table_name(subnetDict, str(i+1))
+                if tableName in self.routeTables:
+                    continue
+                routeTable = t.add_resource(ec2.RouteTable(
+                    tableName,
+                    VpcId=Ref(self.vpc),
+                    Tags=self.defaultTags + [
+                    ec2.Tag('Name', Join("", [
+                        self.namePrefix,
+                        tableName
+                    ]))
+                ]
+                ))
+                self.routeTables[tableName] = Ref(routeTable)
 
     def add_routes(self):
         t = self.template
@@ -171,13 +245,24 @@ class Vpc(object):
                     GatewayId=Ref(self.igw)
                 ))
             # Add route to NAT Gateway
-            if subnetDict['useNat']:
+            if subnetDict['useNat'] and self.natMode == 'single':
                 natGwRoute = t.add_resource(ec2.Route(
                     'NatGwRouteFor{}RouteTable'.format(subnetDict['tier']),
                     RouteTableId=Ref(subnetDict['tier']+'RouteTable'),
                     DestinationCidrBlock='0.0.0.0/0',
-                    NatGatewayId=Ref(self.natGw)
+                    NatGatewayId=Ref(self.natGws['1'])
                 ))
+            # Add route to the NAT Gateway in the same AZ
+            elif subnetDict['useNat']:
+                for i in range(0, self.numAz):
+                    azNum = str(i+1)
+                    tableName = self.route_table_name(subnetDict, azNum)
+                    natGwRoute = t.add_resource(ec2.Route(
+                        'NatGwRouteFor{}'.format(tableName),
+                        RouteTableId=Ref(tableName),
+                        DestinationCidrBlock='0.0.0.0/0',
+                        NatGatewayId=Ref(self.natGws[azNum])
+                    ))
 
     def associate_route_tables(self):
         t = self.template
@@ -187,7 +272,7 @@ class Vpc(object):
                 azNum = str(i+1)
                 subnetName = subnetDict['tier']+'Az'+azNum+'Subnet'
                 subnetId = subnetDict['ID'+azNum]
-                routeTableId = Ref(subnetDict['tier']+'RouteTable')
+                routeTableId = Ref(self.route_table_name(subnetDict, azNum))
                 self.route_subnet_association(t, subnetName, subnetId, routeTableId)
 
     def route_subnet_association(self, t, subnetName, subnetId, routeTableId):
@@ -197,6 +282,31 @@ class Vpc(object):
             RouteTableId=routeTableId,
         ))
 
+    def add_gateway_endpoints(self):
+        t = self.template
+
+        # Gateway endpoints are added to the route tables of every tier
+        # without an Internet Gateway so their traffic skips the NAT.
+        privateRouteTables = []
+        for subnetDict in self.subnets:
+            if subnetDict['useIgw']:
+                continue
+            for i in range(0, self.numAz):
+                tableName = self.route_table_name(subnetDict, str(i+1))
+                if self.routeTables[tableName] not in privateRouteTables:
+                    privateRouteTables.append(self.routeTables[tableName])
+
+        for service in self.sceptreUserData.get('gatewayEndpoints', []):
+            if service not in ['s3', 'dynamodb']:
+                raise ValueError("Unknown gateway endpoint '{}', must be s3 or dynamodb".format(service))
+            endpoint = t.add_resource(ec2.VPCEndpoint(
+                '{}GatewayEndpoint'.format(service.capitalize()),
+                VpcId=Ref(self.vpc),
+                VpcEndpointType='Gateway',
+                ServiceName=Join("", ['com.amazonaws.', Ref('AWS::Region'), '.', service]),
+                RouteTableIds=privateRouteTables
+            ))
+
     def add_outputs(self):
         t = self.template
 
@@ -244,9 +354,14 @@ class Vpc(object):
             ))
 
 
-def sceptre_handler(sceptre_user_data):
+def render(sceptre_user_data):
     vpc = Vpc(sceptre_user_data)
-    return vpc.template.to_json()
+    return template_output.serialize(vpc.template, sceptre_user_data)
+
+def sceptre_handler(sceptre_user_data):
+    return render_cache.cached_render(
+        __file__, sceptre_user_data,
+        lambda: render_client.render(__file__, sceptre_user_data, render))
 
 if __name__ == '__main__':
     # for debugging
@@ -0,0 +1,11 @@
+# Renders templates/server.py through the warm render daemon, see
+# tools/render_daemon.py. Point a stack's template_path here to skip
+# importing troposphere when the daemon is running.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import render_client
+
+sceptre_handler = render_client.remote_handler('server')
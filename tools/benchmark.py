@@ -0,0 +1,241 @@
+# !/usr/bin/env python
+# Benchmarks the sceptre_handler of each template over a matrix of
+# synthetic stack sizes and compares the results between runs.
+#
+#   python tools/benchmark.py run --output before.json
+#   python tools/benchmark.py run --output after.json
+#   python tools/benchmark.py compare before.json after.json
+#
+# Only troposphere and PyYAML are needed, nothing talks to AWS.
+
+import argparse
+import copy
+import importlib
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from stack_config import CONFIG_DIR, ENVIRONMENT, TEMPLATES_DIR, load_stack, placeholder
+
+# Sceptre puts the templates directory on the path so they can import
+# their helper modules.
+sys.path.insert(0, TEMPLATES_DIR)
+# Cache hits would hide the render cost being measured
+os.environ['SCEPTRE_RENDER_CACHE'] = 'off'
+
+TEMPLATES = ['vpc', 'server', 'openvpn']
+# The tiers server.py looks up in its subnets dict
+SERVER_TIERS = ['publicInfra', 'privateWeb', 'privateData']
+RESULTS_VERSION = 1
+
+
+def load_user_data(name):
+    return load_stack(os.path.join(CONFIG_DIR, ENVIRONMENT, name + '.yaml')).userData
+
+
+def parse_range(value):
+    # Accepts 3, 1-6 or 1,2,4
+    numbers = []
+    for part in value.split(','):
+        if '-' in part:
+            low, high = part.split('-')
+            numbers.extend(range(int(low), int(high)+1))
+        else:
+            numbers.append(int(part))
+    return sorted(set(numbers))
+
+
+def vpc_user_data(base, numAz, numTiers):
+    userData = copy.deepcopy(base)
+    userData['numAz'] = numAz
+    # The generated tiers don't list addresses, so they are carved
+    userData['subnetPrefixLength'] = userData.get('subnetPrefixLength', 24)
+    userData['carveCidr'] = userData.get('carveCidr', '10.1.0.0/16')
+    userData['azSlots'] = max(numAz, userData.get('azSlots', 6))
+    # One public tier, the rest alternate between NAT and isolated tiers
+    subnets = [{'tier': 'publicInfra', 'useNat': 0, 'useIgw': 1}]
+    for i in range(1, numTiers):
+        subnets.append({'tier': 'private{}'.format(i), 'useNat': i % 2, 'useIgw': 0})
+    userData['subnets'] = subnets
+    return userData
+
+
+def server_user_data(base, numAz, numTiers):
+    userData = copy.deepcopy(base)
+    userData['subnets'] = {}
+    for tier in SERVER_TIERS:
+        for i in range(0, numAz):
+            name = '{}AZ{}Id'.format(tier, i+1)
+            userData['subnets'][name] = placeholder('vpc', name)
+    return userData
+
+
+def openvpn_user_data(base, numAz, numTiers):
+    return copy.deepcopy(base)
+
+# How each template's user data follows the matrix, and which axes it
+# depends on. Templates that ignore an axis are only run once along it.
+USER_DATA_BUILDERS = {
+    'vpc': (vpc_user_data, ['numAz', 'numTiers']),
+    'server': (server_user_data, ['numAz']),
+    'openvpn': (openvpn_user_data, []),
+}
+
+
+def build_cases(templates, azCounts, tierCounts):
+    cases = []
+    for name in templates:
+        builder, axes = USER_DATA_BUILDERS[name]
+        for numAz in (azCounts if 'numAz' in axes else [None]):
+            for numTiers in (tierCounts if 'numTiers' in axes else [None]):
+                cases.append((name, numAz, numTiers))
+    return cases
+
+
+def measure(handler, userData, repeat):
+    # Each render gets its own copy, templates are free to mutate it
+    copies = [copy.deepcopy(userData) for i in range(0, repeat + 1)]
+
+    timings = []
+    for i in range(0, repeat):
+        start = time.perf_counter()
+        body = handler(copies[i])
+        timings.append(time.perf_counter() - start)
+
+    # Memory is traced on a separate render as tracing slows it down
+    tracemalloc.start()
+    handler(copies[repeat])
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return timings, peakMemory, body
+
+
+def run(args):
+    azCounts = parse_range(args.azs)
+    tierCounts = parse_range(args.tiers)
+    handlers = {}
+    baseUserData = {}
+    for name in args.templates:
+        handlers[name] = importlib.import_module(name).sceptre_handler
+        baseUserData[name] = load_user_data(name)
+
+    results = []
+    for name, numAz, numTiers in build_cases(args.templates, azCounts, tierCounts):
+        builder = USER_DATA_BUILDERS[name][0]
+        userData = builder(baseUserData[name], numAz or 3, numTiers or 3)
+        # Warm up imports and troposphere's caches before timing
+        handlers[name](copy.deepcopy(userData))
+        timings, peakMemory, body = measure(handlers[name], userData, args.repeat)
+        template = json.loads(body)
+        result = {
+            'template': name,
+            'numAz': numAz,
+            'numTiers': numTiers,
+            'repeat': args.repeat,
+            'minSeconds': min(timings),
+            'medianSeconds': statistics.median(timings),
+            'peakMemoryBytes': peakMemory,
+            'resources': len(template.get('Resources', {})),
+            'outputs': len(template.get('Outputs', {})),
+            'templateBytes': len(body),
+        }
+        results.append(result)
+        if not args.quiet:
+            print('{:<8} az={:<4} tiers={:<4} median={:8.2f}ms peak={:8.1f}KiB resources={}'.format(
+                name, str(numAz or '-'), str(numTiers or '-'),
+                result['medianSeconds'] * 1000, peakMemory / 1024.0, result['resources']),
+                file=sys.stderr)
+
+    report = {
+        'version': RESULTS_VERSION,
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'troposphere': importlib.import_module('troposphere').__version__,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(report, outputFile, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+def case_key(result):
+    return (result['template'], result['numAz'], result['numTiers'])
+
+
+def compare(args):
+    with open(args.baseline) as baselineFile:
+        baseline = json.load(baselineFile)
+    with open(args.current) as currentFile:
+        current = json.load(currentFile)
+
+    baselineResults = dict((case_key(r), r) for r in baseline['results'])
+    regressions = []
+    rows = []
+    for result in current['results']:
+        key = case_key(result)
+        if key not in baselineResults:
+            continue
+        before = baselineResults[key]
+        # Time is compared on the median so one slow run doesn't flag it
+        for metric, threshold in [('medianSeconds', args.time_threshold),
+                                  ('peakMemoryBytes', args.memory_threshold),
+                                  ('templateBytes', args.size_threshold)]:
+            if not before[metric]:
+                continue
+            change = (result[metric] - before[metric]) / float(before[metric])
+            regressed = change > threshold
+            rows.append((key, metric, before[metric], result[metric], change, regressed))
+            if regressed:
+                regressions.append(rows[-1])
+
+    for key, metric, before, after, change, regressed in rows:
+        if regressed or args.verbose:
+            print('{} {:<8} az={:<4} tiers={:<4} {:<16} {:>14.6g} -> {:<14.6g} {:+7.1%}'.format(
+                'REGRESSION' if regressed else 'ok        ',
+                key[0], str(key[1] or '-'), str(key[2] or '-'), metric, before, after, change))
+
+    missing = set(baselineResults) - set(case_key(r) for r in current['results'])
+    if missing:
+        print('{} baseline cases were not in the current run'.format(len(missing)))
+    print('{} regressions in {} comparisons'.format(len(regressions), len(rows)))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the sceptre templates')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    runParser = commands.add_parser('run', help='Render the templates over the size matrix')
+    runParser.add_argument('--templates', nargs='+', default=TEMPLATES, choices=TEMPLATES)
+    runParser.add_argument('--azs', default='1-6', help='AZ counts, e.g. 1-6 or 1,3,6')
+    runParser.add_argument('--tiers', default='3-20', help='Subnet tier counts for the VPC')
+    runParser.add_argument('--repeat', type=int, default=5, help='Timed renders per case')
+    runParser.add_argument('--output', help='Results file, stdout if not set')
+    runParser.add_argument('--quiet', action='store_true')
+    runParser.set_defaults(func=run)
+
+    compareParser = commands.add_parser('compare', help='Flag regressions between two runs')
+    compareParser.add_argument('baseline')
+    compareParser.add_argument('current')
+    compareParser.add_argument('--time-threshold', type=float, default=0.25,
+                               help='Allowed growth of the median render time, 0.25 is 25%%')
+    compareParser.add_argument('--memory-threshold', type=float, default=0.10)
+    compareParser.add_argument('--size-threshold', type=float, default=0.0)
+    compareParser.add_argument('--verbose', action='store_true', help='Show every comparison')
+    compareParser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
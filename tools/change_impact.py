@@ -0,0 +1,315 @@
+# !/usr/bin/env python
+# Predicts what CloudFormation will do to each resource when a stack is
+# updated from one rendered template to another, without calling AWS.
+#
+#   python tools/render.py --output before
+#   (edit the templates or configs)
+#   python tools/render.py --output after
+#   python tools/change_impact.py before/server.json after/server.json
+#
+# Property changes are classified from update_behaviors.yaml. Replaced
+# resources change the Ref and GetAtt values of everything using them, so
+# those changes are followed through the template too. When a change
+# rolls an auto scaling group the duration is estimated from its
+# UpdatePolicy.
+
+import argparse
+import json
+import math
+import os
+import re
+import sys
+
+import yaml
+
+BEHAVIORS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'update_behaviors.yaml')
+SEVERITY = ['none', 'some', 'replace']
+RESOURCE_ATTRIBUTES = ['Metadata', 'UpdatePolicy', 'CreationPolicy', 'DeletionPolicy',
+                       'UpdateReplacePolicy', 'DependsOn', 'Condition']
+SUB_REFERENCE = re.compile(r'\$\{([A-Za-z0-9]+)(?:\.([A-Za-z0-9.]+))?\}')
+DURATION = re.compile(r'^PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?$')
+
+
+def load_behaviors(path=BEHAVIORS_PATH):
+    with open(path) as behaviorsFile:
+        return yaml.safe_load(behaviorsFile)
+
+
+def load_template(path):
+    with open(path) as templateFile:
+        return json.load(templateFile)
+
+
+def references(value):
+    """Returns the (name, attribute) pairs a value refers to, attribute
+    being None for a Ref."""
+    found = set()
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'Ref' and isinstance(item, str):
+                found.add((item, None))
+            elif key == 'Fn::GetAtt':
+                parts = item.split('.', 1) if isinstance(item, str) else item
+                if isinstance(parts[0], str) and len(parts) > 1:
+                    found.add((parts[0], parts[1] if isinstance(parts[1], str) else None))
+            elif key == 'Fn::Sub':
+                text = item[0] if isinstance(item, list) else item
+                for name, attribute in SUB_REFERENCE.findall(text):
+                    found.add((name, attribute or None))
+            found.update(references(item))
+    elif isinstance(value, list):
+        for item in value:
+            found.update(references(item))
+    return found
+
+
+def property_behavior(behaviors, resourceType, name):
+    typeBehaviors = behaviors.get(resourceType)
+    if typeBehaviors is None:
+        return 'unknown'
+    return typeBehaviors.get('properties', {}).get(name, typeBehaviors.get('default', 'unknown'))
+
+
+def worst(levels):
+    known = [level for level in levels if level in SEVERITY]
+    if 'unknown' in levels:
+        return 'unknown'
+    return max(known, key=SEVERITY.index) if known else 'none'
+
+
+class ResourceChange(object):
+    def __init__(self, name, resourceType, action):
+        self.name = name
+        self.type = resourceType
+        # create, delete or update
+        self.action = action
+        # property -> (behavior, reason)
+        self.properties = {}
+        self.attributes = []
+        self.rollingUpdate = None
+
+    @property
+    def behavior(self):
+        if self.action != 'update':
+            return self.action
+        return worst([behavior for behavior, reason in self.properties.values()])
+
+    def to_dict(self):
+        return {
+            'type': self.type,
+            'action': self.action,
+            'behavior': self.behavior,
+            'properties': dict((name, {'behavior': behavior, 'reason': reason})
+                               for name, (behavior, reason) in self.properties.items()),
+            'attributes': self.attributes,
+            'rollingUpdate': self.rollingUpdate,
+        }
+
+
+def changed_parameters(old, new):
+    changed = set()
+    oldParameters = old.get('Parameters', {})
+    for name, parameter in new.get('Parameters', {}).items():
+        if name in oldParameters and oldParameters[name].get('Default') != parameter.get('Default'):
+            changed.add(name)
+    return changed
+
+
+def diff_templates(old, new, behaviors):
+    oldResources = old.get('Resources', {})
+    newResources = new.get('Resources', {})
+    changes = {}
+
+    for name in sorted(set(oldResources) | set(newResources)):
+        if name not in oldResources:
+            changes[name] = ResourceChange(name, newResources[name]['Type'], 'create')
+            continue
+        if name not in newResources:
+            changes[name] = ResourceChange(name, oldResources[name]['Type'], 'delete')
+            continue
+
+        before, after = oldResources[name], newResources[name]
+        change = ResourceChange(name, after['Type'], 'update')
+        if before['Type'] != after['Type']:
+            change.properties['Type'] = ('replace', 'resource type changed')
+        oldProperties = before.get('Properties', {})
+        newProperties = after.get('Properties', {})
+        for prop in sorted(set(oldProperties) | set(newProperties)):
+            if oldProperties.get(prop) != newProperties.get(prop):
+                change.properties[prop] = (property_behavior(behaviors, after['Type'], prop), 'changed')
+        for attribute in RESOURCE_ATTRIBUTES:
+            if before.get(attribute) != after.get(attribute):
+                change.attributes.append(attribute)
+        if change.properties or change.attributes:
+            changes[name] = change
+
+    # A changed value spreads to every property using it
+    changedValues = set((name, None) for name in changed_parameters(old, new))
+    while True:
+        changedValues.update(changed_values(changes, behaviors))
+        spread = False
+        for name, resource in newResources.items():
+            if name not in oldResources or oldResources[name]['Type'] != resource['Type']:
+                continue
+            for prop, value in resource.get('Properties', {}).items():
+                if name in changes and prop in changes[name].properties:
+                    continue
+                causes = sorted(set(source for source, attribute in references(value)
+                                    if (source, None) in changedValues or (source, attribute) in changedValues))
+                if not causes:
+                    continue
+                change = changes.setdefault(name, ResourceChange(name, resource['Type'], 'update'))
+                change.properties[prop] = (property_behavior(behaviors, resource['Type'], prop),
+                                           'value of {} changes'.format(', '.join(causes)))
+                spread = True
+        if not spread:
+            break
+    return changes
+
+
+def changed_values(changes, behaviors):
+    values = set()
+    for name, change in changes.items():
+        if change.behavior in ['replace', 'delete', 'create']:
+            # A new physical resource changes its Ref and every attribute
+            values.add((name, None))
+        elif change.properties:
+            for attribute in behaviors.get(change.type, {}).get('changesAttributes', []):
+                values.add((name, attribute))
+    return values
+
+
+def parse_duration(value):
+    match = DURATION.match(value or '')
+    if not match:
+        raise ValueError("Bad duration '{}', must be like PT5M30S".format(value))
+    hours, minutes, seconds = [int(part or 0) for part in match.groups()]
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def resolve_number(value, template, fallback):
+    # Sizes are often parameters, their defaults are used offline
+    if isinstance(value, dict) and 'Ref' in value:
+        value = template.get('Parameters', {}).get(value['Ref'], {}).get('Default')
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return fallback
+
+
+def estimate_rolling_update(asg, template, instances, launchSeconds, bootSeconds):
+    properties = asg.get('Properties', {})
+    policy = asg.get('UpdatePolicy', {})
+    if instances is None:
+        instances = resolve_number(properties.get('DesiredCapacity'), template, None)
+    if instances is None:
+        instances = resolve_number(properties.get('MinSize'), template, 1)
+
+    if policy.get('AutoScalingReplacingUpdate', {}).get('WillReplace') in [True, 'true']:
+        return {'kind': 'replacing', 'instances': instances,
+                'seconds': launchSeconds + bootSeconds,
+                'summary': 'a new group of {} instances is launched beside the old one'.format(instances)}
+
+    rolling = policy.get('AutoScalingRollingUpdate')
+    if rolling is None:
+        return {'kind': 'none', 'instances': instances, 'seconds': 0,
+                'summary': 'no UpdatePolicy, running instances keep the old configuration'}
+
+    maxBatch = int(rolling.get('MaxBatchSize', 1))
+    minInService = int(rolling.get('MinInstancesInService', 0))
+    waitOnSignals = rolling.get('WaitOnResourceSignals') in [True, 'true']
+    pause = parse_duration(rolling.get('PauseTime', 'PT5M' if waitOnSignals else 'PT0S'))
+    # Old instances are only terminated while enough stay in service,
+    # otherwise new ones are launched first.
+    batchSize = max(1, min(maxBatch, instances - minInService)) if instances > minInService else maxBatch
+    batches = int(math.ceil(instances / float(batchSize)))
+    # With signals a batch takes until its instances boot, at most the
+    # pause. Without them CloudFormation only waits the pause.
+    batchSeconds = launchSeconds + (min(bootSeconds, pause) if waitOnSignals else pause)
+    return {
+        'kind': 'rolling',
+        'instances': instances,
+        'batchSize': batchSize,
+        'batches': batches,
+        'minInstancesInService': minInService,
+        'waitOnResourceSignals': waitOnSignals,
+        'pauseSeconds': pause,
+        'seconds': batches * batchSeconds,
+        'summary': '{} instances in {} batches of {}, {} in service'.format(
+            instances, batches, batchSize, minInService),
+    }
+
+
+def add_rolling_updates(changes, behaviors, new, args):
+    for name, change in changes.items():
+        if change.action != 'update' or change.behavior == 'replace':
+            continue
+        triggers = behaviors.get(change.type, {}).get('rollingUpdate', [])
+        rolled = sorted(prop for prop in change.properties if prop in triggers)
+        if rolled:
+            change.rollingUpdate = estimate_rolling_update(
+                new['Resources'][name], new, args.instances, args.launch_seconds, args.boot_seconds)
+            change.rollingUpdate['triggeredBy'] = rolled
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return '{}m{:02d}s'.format(minutes, seconds)
+
+
+def print_report(changes):
+    order = ['delete', 'replace', 'unknown', 'some', 'create', 'none']
+    for name in sorted(changes, key=lambda name: (order.index(changes[name].behavior), name)):
+        change = changes[name]
+        print('{:<8} {} ({})'.format(change.behavior.upper(), name, change.type))
+        for prop in sorted(change.properties):
+            behavior, reason = change.properties[prop]
+            print('           {:<28} {:<8} {}'.format(prop, behavior, reason))
+        if change.attributes:
+            print('           {:<28} {:<8} {}'.format(', '.join(change.attributes), 'none', 'resource attributes changed'))
+        if 'Metadata' in change.attributes:
+            print('           cfn-hup re-runs cfn-init on running instances')
+        if change.rollingUpdate:
+            update = change.rollingUpdate
+            print('           rolling update from {}: {}, about {}'.format(
+                ', '.join(update['triggeredBy']), update['summary'], format_seconds(update['seconds'])))
+
+    counts = {}
+    for change in changes.values():
+        counts[change.behavior] = counts.get(change.behavior, 0) + 1
+    print('{} resources change: {}'.format(len(changes), ', '.join(
+        '{} {}'.format(counts[level], level) for level in order if level in counts)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Predict the impact of a stack update offline')
+    parser.add_argument('before', help='Template deployed now')
+    parser.add_argument('after', help='Template to deploy')
+    parser.add_argument('--instances', type=int, help='Instances in service, the DesiredCapacity if not set')
+    parser.add_argument('--launch-seconds', type=int, default=60, help='Time to launch an instance')
+    parser.add_argument('--boot-seconds', type=int, default=600, help='Time for an instance to finish cfn-init')
+    parser.add_argument('--fail-on', choices=['some', 'replace'], help='Exit 1 on changes this disruptive')
+    parser.add_argument('--json', action='store_true', help='Print the changes as JSON')
+    args = parser.parse_args(argv)
+
+    behaviors = load_behaviors()
+    old = load_template(args.before)
+    new = load_template(args.after)
+    changes = diff_templates(old, new, behaviors)
+    add_rolling_updates(changes, behaviors, new, args)
+
+    if args.json:
+        json.dump(dict((name, change.to_dict()) for name, change in changes.items()),
+                  sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print_report(changes)
+
+    if args.fail_on:
+        failLevels = SEVERITY[SEVERITY.index(args.fail_on):] + ['unknown', 'delete']
+        if any(change.behavior in failLevels for change in changes.values()):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
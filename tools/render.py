@@ -0,0 +1,144 @@
+# !/usr/bin/env python
+# Renders every stack of an environment offline, in parallel where the
+# !stack_output references between them allow it.
+#
+#   python tools/render.py --output build/templates
+#   python tools/render.py --stacks server --jobs 1
+#
+# Outputs of other stacks are replaced by {{stack_output:stack::output}}
+# placeholders. A stack is only started once the stacks it depends on
+# have rendered, so the launch order printed is the order sceptre has to
+# create them in.
+
+import argparse
+import concurrent.futures
+import importlib.util
+import json
+import os
+import sys
+import time
+
+from stack_config import ENVIRONMENT, launch_order, load_environment
+
+
+def render_stack(name, templatePath, userData):
+    # Runs in the worker processes. Sceptre puts the template's directory
+    # on the path so its helper modules can be imported.
+    templateDir = os.path.dirname(templatePath)
+    if templateDir not in sys.path:
+        sys.path.insert(0, templateDir)
+    moduleName = os.path.splitext(os.path.basename(templatePath))[0]
+    start = time.time()
+    spec = importlib.util.spec_from_file_location(moduleName, templatePath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    body = module.sceptre_handler(userData)
+    return name, body, start, time.time()
+
+
+def dependency_closure(stacks, names):
+    needed = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name in needed:
+            continue
+        if name not in stacks:
+            raise ValueError("Unknown stack '{}', must be one of {}".format(name, ', '.join(sorted(stacks))))
+        needed.add(name)
+        pending.extend(stacks[name].dependencies)
+    return dict((name, stacks[name]) for name in needed)
+
+
+def render_all(stacks, jobs=None):
+    """Renders the stacks in a process pool, submitting each one when its
+    dependencies are done. Returns {name: (body, start, end)}."""
+    # Checks for cycles before anything is started
+    launch_order(stacks)
+
+    rendered = {}
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        while len(rendered) < len(stacks):
+            for name in sorted(stacks):
+                if name in rendered or name in running.values():
+                    continue
+                if all(dep in rendered for dep in stacks[name].dependencies):
+                    stack = stacks[name]
+                    future = pool.submit(render_stack, name, stack.templatePath, stack.userData)
+                    running[future] = name
+            done, notDone = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name, body, start, end = future.result()
+                rendered[name] = (body, start, end)
+                del running[future]
+    return rendered
+
+
+def critical_path(stacks, durations):
+    # Longest chain of render times through the dependency graph
+    finish = {}
+    path = {}
+    for level in launch_order(stacks):
+        for name in level:
+            before = max([(finish[dep], dep) for dep in stacks[name].dependencies] or [(0, None)])
+            finish[name] = before[0] + durations[name]
+            path[name] = (path[before[1]] if before[1] else []) + [name]
+    last = max(finish, key=lambda name: finish[name])
+    return path[last], finish[last]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render the stacks of an environment offline')
+    parser.add_argument('--environment', default=ENVIRONMENT)
+    parser.add_argument('--stacks', nargs='+', help='Only these stacks and the ones they depend on')
+    parser.add_argument('--jobs', type=int, help='Worker processes, one per CPU if not set')
+    parser.add_argument('--output', help='Directory to write <stack>.json templates to')
+    parser.add_argument('--report', help='Write the launch order and timings as JSON')
+    args = parser.parse_args(argv)
+
+    stacks = load_environment(args.environment)
+    if args.stacks:
+        stacks = dependency_closure(stacks, args.stacks)
+
+    start = time.time()
+    rendered = render_all(stacks, args.jobs)
+    wallSeconds = time.time() - start
+
+    if args.output:
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        for name, (body, stackStart, stackEnd) in rendered.items():
+            with open(os.path.join(args.output, name + '.json'), 'w') as templateFile:
+                templateFile.write(body)
+
+    durations = dict((name, end - begin) for name, (body, begin, end) in rendered.items())
+    levels = launch_order(stacks)
+    path, pathSeconds = critical_path(stacks, durations)
+
+    print('Launch order:')
+    for levelNum, level in enumerate(levels):
+        for name in level:
+            print('  {} {:<12} {:8.1f}ms  after: {}'.format(
+                levelNum + 1, name, durations[name] * 1000,
+                ', '.join(stacks[name].dependencies) or '-'))
+    print('Critical path: {} ({:.1f}ms)'.format(' -> '.join(path), pathSeconds * 1000))
+    print('Wall time: {:.1f}ms'.format(wallSeconds * 1000))
+
+    if args.report:
+        report = {
+            'environment': args.environment,
+            'launchOrder': levels,
+            'dependencies': dict((name, stacks[name].dependencies) for name in stacks),
+            'renderSeconds': durations,
+            'criticalPath': path,
+            'criticalPathSeconds': pathSeconds,
+            'wallSeconds': wallSeconds,
+        }
+        with open(args.report, 'w') as reportFile:
+            json.dump(report, reportFile, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
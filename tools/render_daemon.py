@@ -0,0 +1,159 @@
+# !/usr/bin/env python
+# Keeps troposphere and the templates imported and renders them for
+# sceptre_handler over a Unix socket, so repeated renders skip the
+# interpreter start up and imports.
+#
+#   python tools/render_daemon.py serve --socket /tmp/sceptre-render.sock &
+#   export SCEPTRE_RENDER_DAEMON=/tmp/sceptre-render.sock
+#   sceptre launch-env wordpress
+#
+# Stacks whose template_path points at templates/warm/<name>.py don't
+# import troposphere at all when the daemon answers.
+#
+# Each render runs in a forked child of the warm process, so renders run
+# side by side and can't leave state behind. Templates are re-imported
+# when a file in the templates directory changes.
+
+import argparse
+import importlib
+import json
+import os
+import signal
+import socketserver
+import sys
+import time
+import traceback
+
+from stack_config import TEMPLATES_DIR
+
+sys.path.insert(0, TEMPLATES_DIR)
+# The templates must render here rather than call back to a daemon
+os.environ.pop('SCEPTRE_RENDER_DAEMON', None)
+
+DEFAULT_SOCKET = '/tmp/sceptre-render.sock'
+TEMPLATES = ['vpc', 'openvpn', 'server']
+PRELOAD_MODULES = [
+    'troposphere',
+    'troposphere.ec2',
+    'troposphere.rds',
+    'troposphere.autoscaling',
+    'troposphere.applicationautoscaling',
+    'troposphere.elasticloadbalancing',
+    'troposphere.elasticloadbalancingv2',
+    'troposphere.cloudformation',
+    'troposphere.cloudfront',
+    'troposphere.cloudwatch',
+    'troposphere.elasticache',
+    'troposphere.efs',
+    'troposphere.iam',
+    'troposphere.s3',
+]
+
+
+def templates_stamp():
+    stamp = []
+    for fileName in sorted(os.listdir(TEMPLATES_DIR)):
+        if fileName.endswith('.py'):
+            stamp.append((fileName, os.stat(os.path.join(TEMPLATES_DIR, fileName)).st_mtime))
+    return stamp
+
+
+def load_templates():
+    # Drops every module from the templates directory first so helpers
+    # like capacity.py are reloaded along with the templates.
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None) or ''
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(TEMPLATES_DIR):
+            del sys.modules[name]
+    return dict((name, importlib.import_module(name)) for name in TEMPLATES)
+
+
+class RenderHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        start = time.time()
+        try:
+            message = json.loads(self.rfile.read().decode('utf-8'))
+            response = self.server.dispatch(message)
+        except Exception as e:
+            response = {'error': '{}: {}'.format(type(e).__name__, e),
+                        'traceback': traceback.format_exc()}
+        response['seconds'] = time.time() - start
+        self.wfile.write(json.dumps(response).encode('utf-8'))
+
+
+class RenderServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    def __init__(self, socketPath):
+        for name in PRELOAD_MODULES:
+            importlib.import_module(name)
+        self.templates = load_templates()
+        self.stamp = templates_stamp()
+        self.renders = 0
+        socketserver.UnixStreamServer.__init__(self, socketPath, RenderHandler)
+
+    def process_request(self, request, client_address):
+        # Reloading in the parent keeps the warm modules for later forks
+        stamp = templates_stamp()
+        if stamp != self.stamp:
+            self.templates = load_templates()
+            self.stamp = stamp
+        self.renders += 1
+        socketserver.ForkingMixIn.process_request(self, request, client_address)
+
+    def dispatch(self, message):
+        command = message.get('command')
+        if command == 'ping':
+            return {'pid': os.getpid(), 'templatesDir': TEMPLATES_DIR,
+                    'templates': sorted(self.templates), 'renders': self.renders}
+        if command != 'render':
+            raise ValueError("Unknown command '{}', must be render or ping".format(command))
+
+        templatePath = os.path.abspath(message['templatePath'])
+        # Only templates from the directory loaded here can be rendered
+        if os.path.dirname(templatePath) != os.path.abspath(TEMPLATES_DIR):
+            raise ValueError('{} is not in {}'.format(templatePath, TEMPLATES_DIR))
+        name = os.path.splitext(os.path.basename(templatePath))[0]
+        if name not in self.templates:
+            raise ValueError("Unknown template '{}', must be one of {}".format(name, ', '.join(TEMPLATES)))
+        # The handler still checks the render cache
+        return {'body': self.templates[name].sceptre_handler(message['userData'])}
+
+
+def serve(args):
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = RenderServer(args.socket)
+    os.chmod(args.socket, 0o600)
+    sys.stderr.write('rendering {} on {}\n'.format(', '.join(TEMPLATES), args.socket))
+    # Stopping with kill removes the socket too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+    return 0
+
+
+def ping(args):
+    import render_client
+    print(json.dumps(render_client.request(args.socket, {'command': 'ping'}), indent=2, sort_keys=True))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Warm template render daemon')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    serveParser = commands.add_parser('serve', help='Run the daemon')
+    serveParser.add_argument('--socket', default=DEFAULT_SOCKET)
+    serveParser.set_defaults(func=serve)
+    pingParser = commands.add_parser('ping', help='Show the state of a running daemon')
+    pingParser.add_argument('--socket', default=DEFAULT_SOCKET)
+    pingParser.set_defaults(func=ping)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
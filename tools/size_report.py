@@ -0,0 +1,155 @@
+# !/usr/bin/env python
+# Breaks the size of the rendered templates down per resource, output and
+# metadata block, and warns when a template nears CloudFormation's limits.
+#
+#   python tools/size_report.py
+#   python tools/size_report.py --stacks server --compact --dedup-joins
+#   python tools/size_report.py --budget bodyBytes=40000 --warn-at 0.9
+#
+# Exits non-zero when a budget is exceeded.
+
+import argparse
+import copy
+import json
+import sys
+
+from render import render_stack
+from stack_config import ENVIRONMENT, load_environment
+
+# CloudFormation quotas, bodyBytes is the limit for an inline TemplateBody
+# and s3BodyBytes for one uploaded to S3.
+DEFAULT_BUDGETS = {
+    'bodyBytes': 51200,
+    's3BodyBytes': 1000000,
+    'resources': 500,
+    'outputs': 200,
+    'parameters': 200,
+    'mappings': 200,
+}
+INIT_KEY = 'AWS::CloudFormation::Init'
+
+
+def json_bytes(value):
+    # Pieces are measured compact so the breakdown doesn't depend on the
+    # indentation of the body.
+    return len(json.dumps(value, sort_keys=True, separators=(',', ':')))
+
+
+def analyze(body):
+    template = json.loads(body)
+    report = {
+        'bodyBytes': len(body),
+        'resources': len(template.get('Resources', {})),
+        'outputs': len(template.get('Outputs', {})),
+        'parameters': len(template.get('Parameters', {})),
+        'mappings': len(template.get('Mappings', {})),
+        'sections': {},
+        'resourceBytes': {},
+        'outputBytes': {},
+        'metadataBytes': {},
+    }
+    for section, value in template.items():
+        report['sections'][section] = json_bytes(value)
+    for name, output in template.get('Outputs', {}).items():
+        report['outputBytes'][name] = json_bytes(output)
+
+    for name, resource in template.get('Resources', {}).items():
+        report['resourceBytes'][name] = json_bytes(resource)
+        metadata = resource.get('Metadata', {})
+        for key, block in metadata.items():
+            if key != INIT_KEY:
+                report['metadataBytes']['{}.{}'.format(name, key)] = json_bytes(block)
+                continue
+            # cfn-init metadata is broken down per config
+            for configName, config in block.items():
+                report['metadataBytes']['{}.{}'.format(name, configName)] = json_bytes(config)
+    return report
+
+
+def check_budgets(report, budgets, warnAt):
+    warnings = []
+    exceeded = False
+    for name, limit in sorted(budgets.items()):
+        # The S3 limit applies to the same body
+        used = report['bodyBytes'] if name == 's3BodyBytes' else report[name]
+        if used > limit:
+            warnings.append('EXCEEDED {} is {} of {}'.format(name, used, limit))
+            exceeded = True
+        elif used > limit * warnAt:
+            warnings.append('WARNING  {} is {} of {} ({:.0%})'.format(name, used, limit, used / float(limit)))
+    return warnings, exceeded
+
+
+def print_largest(title, sizes, top):
+    if not sizes:
+        return
+    total = sum(sizes.values())
+    print('  {}:'.format(title))
+    for name in sorted(sizes, key=lambda name: (-sizes[name], name))[:top]:
+        print('    {:>8} {:>6.1%}  {}'.format(sizes[name], sizes[name] / float(total), name))
+    if len(sizes) > top:
+        print('    ... {} more'.format(len(sizes) - top))
+
+
+def parse_budgets(values):
+    budgets = dict(DEFAULT_BUDGETS)
+    for value in values or []:
+        name, limit = value.split('=', 1)
+        if name not in DEFAULT_BUDGETS:
+            raise ValueError("Unknown budget '{}', must be one of {}".format(
+                name, ', '.join(sorted(DEFAULT_BUDGETS))))
+        budgets[name] = int(limit)
+    return budgets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report the size of the rendered templates')
+    parser.add_argument('--environment', default=ENVIRONMENT)
+    parser.add_argument('--stacks', nargs='+', help='Stacks to report on, all if not set')
+    parser.add_argument('--compact', action='store_true', help='Render with templateOutput.compact')
+    parser.add_argument('--dedup-joins', action='store_true', help='Render with templateOutput.dedupJoins')
+    parser.add_argument('--budget', action='append', help='Override a budget, e.g. bodyBytes=40000')
+    parser.add_argument('--warn-at', type=float, default=0.8, help='Warn when this share of a budget is used')
+    parser.add_argument('--top', type=int, default=10, help='Largest items listed per breakdown')
+    parser.add_argument('--json', action='store_true', help='Print the reports as JSON')
+    args = parser.parse_args(argv)
+
+    budgets = parse_budgets(args.budget)
+    stacks = load_environment(args.environment)
+    names = args.stacks or sorted(stacks)
+
+    reports = {}
+    exceeded = False
+    for name in names:
+        stack = stacks[name]
+        userData = copy.deepcopy(stack.userData)
+        options = userData.setdefault('templateOutput', {})
+        if args.compact:
+            options['compact'] = True
+        if args.dedup_joins:
+            options['dedupJoins'] = True
+        body = render_stack(name, stack.templatePath, userData)[1]
+        report = analyze(body)
+        report['warnings'], stackExceeded = check_budgets(report, budgets, args.warn_at)
+        exceeded = exceeded or stackExceeded
+        reports[name] = report
+
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return 1 if exceeded else 0
+
+    for name in names:
+        report = reports[name]
+        print('{}: {} bytes, {} resources, {} outputs, {} parameters'.format(
+            name, report['bodyBytes'], report['resources'], report['outputs'], report['parameters']))
+        for warning in report['warnings']:
+            print('  ' + warning)
+        print_largest('sections', report['sections'], args.top)
+        print_largest('resources', report['resourceBytes'], args.top)
+        print_largest('metadata', report['metadataBytes'], args.top)
+        print_largest('outputs', report['outputBytes'], args.top)
+    return 1 if exceeded else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
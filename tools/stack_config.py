@@ -0,0 +1,107 @@
+# Reads the sceptre stack configs offline. !stack_output references are
+# recorded and replaced by placeholder tokens as their stacks can't be
+# queried without AWS.
+
+import os
+
+import yaml
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+CONFIG_DIR = os.path.join(ROOT_DIR, 'config')
+TEMPLATES_DIR = os.path.join(ROOT_DIR, 'templates')
+ENVIRONMENT = 'wordpress'
+# Files in an environment directory which aren't stacks
+NON_STACK_CONFIGS = ['config.yaml']
+
+PLACEHOLDER_FORMAT = '{{{{stack_output:{}::{}}}}}'
+
+
+def placeholder(stackName, outputName):
+    return PLACEHOLDER_FORMAT.format(stackName, outputName)
+
+
+class StackConfigLoader(yaml.SafeLoader):
+    def __init__(self, stream):
+        yaml.SafeLoader.__init__(self, stream)
+        # (stack, output) pairs the config refers to
+        self.stackOutputs = []
+
+
+def construct_stack_output(loader, node):
+    value = loader.construct_scalar(node)
+    if '::' not in value:
+        raise ValueError("Bad !stack_output '{}', must be stack::output".format(value))
+    stackName, outputName = value.split('::', 1)
+    loader.stackOutputs.append((stackName, outputName))
+    return placeholder(stackName, outputName)
+
+
+def construct_external_output(loader, node):
+    # External stacks aren't part of the environment so add no dependency
+    value = loader.construct_scalar(node)
+    return placeholder(*value.split('::', 1))
+
+StackConfigLoader.add_constructor('!stack_output', construct_stack_output)
+StackConfigLoader.add_constructor('!stack_output_external', construct_external_output)
+
+
+class StackConfig(object):
+    def __init__(self, name, path, config, stackOutputs):
+        self.name = name
+        self.path = path
+        self.config = config
+        self.stackOutputs = stackOutputs
+        self.dependencies = sorted(set(stack for stack, output in stackOutputs))
+
+    @property
+    def templatePath(self):
+        return os.path.join(ROOT_DIR, self.config['template_path'])
+
+    @property
+    def userData(self):
+        return self.config.get('sceptre_user_data', {})
+
+
+def load_stack(path, name=None):
+    with open(path) as configFile:
+        loader = StackConfigLoader(configFile)
+        try:
+            config = loader.get_single_data()
+        finally:
+            loader.dispose()
+    name = name or os.path.splitext(os.path.basename(path))[0]
+    return StackConfig(name, path, config or {}, loader.stackOutputs)
+
+
+def load_environment(environment=ENVIRONMENT, configDir=CONFIG_DIR):
+    environmentDir = os.path.join(configDir, environment)
+    stacks = {}
+    for fileName in sorted(os.listdir(environmentDir)):
+        if not fileName.endswith('.yaml') or fileName in NON_STACK_CONFIGS:
+            continue
+        stack = load_stack(os.path.join(environmentDir, fileName))
+        stacks[stack.name] = stack
+
+    for stack in stacks.values():
+        for dependency in stack.dependencies:
+            if dependency not in stacks:
+                raise ValueError("Stack '{}' uses outputs of '{}' which isn't in {}".format(
+                    stack.name, dependency, environmentDir))
+    return stacks
+
+
+def launch_order(stacks):
+    """Groups the stacks into levels, each only depending on earlier
+    levels, so the stacks of a level can be launched together."""
+    levels = []
+    placed = set()
+    remaining = set(stacks)
+    while remaining:
+        level = sorted(name for name in remaining
+                       if all(dep in placed for dep in stacks[name].dependencies))
+        if not level:
+            raise ValueError('Stacks have a dependency cycle: {}'.format(', '.join(sorted(remaining))))
+        levels.append(level)
+        placed.update(level)
+        remaining.difference_update(level)
+    return levels